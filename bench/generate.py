@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+generator filling the results, map and searches tables with synthetic
+ads and users, shaped like the ads of seloger.com: a few postal codes
+gather most of the ads, the surface follows the number of rooms and the
+price follows the surface and the price per square meter of the city
+
+usage: python generate.py [--ads 1000000] [--users 10000] [directory]
+"""
+
+import os
+import sys
+import md5
+import time
+import random
+import logging
+import calendar
+import datetime
+from optparse import OptionParser
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH))
+
+from sandbox import load_plugin
+
+#(postal code, city, weight, rent per m2, price per m2)
+CITIES = [
+    ('75001', u'Paris 1er', 2, 33, 12500),
+    ('75002', u'Paris 2ème', 2, 32, 11500),
+    ('75003', u'Paris 3ème', 3, 33, 12000),
+    ('75004', u'Paris 4ème', 2, 34, 12800),
+    ('75005', u'Paris 5ème', 4, 32, 12000),
+    ('75006', u'Paris 6ème', 3, 36, 14000),
+    ('75007', u'Paris 7ème', 3, 35, 13500),
+    ('75008', u'Paris 8ème', 3, 33, 11800),
+    ('75009', u'Paris 9ème', 4, 30, 10500),
+    ('75010', u'Paris 10ème', 5, 28, 9500),
+    ('75011', u'Paris 11ème', 8, 29, 10000),
+    ('75012', u'Paris 12ème', 7, 27, 9300),
+    ('75013', u'Paris 13ème', 7, 26, 8800),
+    ('75014', u'Paris 14ème', 6, 28, 9800),
+    ('75015', u'Paris 15ème', 10, 29, 10000),
+    ('75016', u'Paris 16ème', 9, 31, 11000),
+    ('75017', u'Paris 17ème', 8, 30, 10300),
+    ('75018', u'Paris 18ème', 8, 26, 8600),
+    ('75019', u'Paris 19ème', 6, 24, 7900),
+    ('75020', u'Paris 20ème', 7, 25, 8200),
+    ('69003', u'Lyon 3ème', 5, 13, 4600),
+    ('69007', u'Lyon 7ème', 4, 13, 4500),
+    ('13008', u'Marseille 8ème', 4, 13, 4200),
+    ('33000', u'Bordeaux', 5, 13, 4400),
+    ('59000', u'Lille', 5, 13, 3500),
+    ('31000', u'Toulouse', 4, 12, 3500),
+    ('44000', u'Nantes', 4, 12, 3700),
+    ('67000', u'Strasbourg', 3, 12, 3400),
+]
+
+#weights of the number of rooms
+ROOMS = [1] * 30 + [2] * 32 + [3] * 22 + [4] * 10 + [5] * 4 + [6] * 2
+
+def make_ad(rand, annonce_id, city, ad_type, now):
+    """returns an ad (tuple of values in the order of val_xml, 
+    typed like the columns of results and results_text)"""
+    (cp, ville, weight, rent, price) = city
+    rooms = rand.choice(ROOMS)
+    surface = round(rooms * rand.uniform(11, 22) + rand.uniform(5, 15), 2)
+    if ad_type == '1':
+        prix = int(surface * rent * rand.lognormvariate(0, 0.15))
+        kind = u'Location'
+    else:
+        prix = int(surface * price * rand.lognormvariate(0, 0.12)) \
+                // 1000 * 1000
+        kind = u'Vente'
+    created = now - datetime.timedelta(seconds=rand.randint(0, 90 * 86400))
+    fresh = created + datetime.timedelta(seconds=rand.randint(0, 86400))
+    titre = rooms == 1 and u'Studio' or u'Appartement %d pièces' % rooms
+    return (
+        str(rand.randint(10000, 99999)),                  #idTiers
+        annonce_id,                                       #idAnnonce
+        str(rand.choice([1, 10])),                        #idPublication
+        ad_type,                                          #idTypeTransaction
+        str(rand.choice([1, 1, 1, 2])),                   #idTypeBien
+        calendar.timegm(fresh.timetuple()),               #dtFraicheur
+        calendar.timegm(created.timetuple()),             #dtCreation
+        titre,                                            #titre
+        ville,                                            #libelle
+        u'Métro, commerces, écoles',                      #proximite
+        u'%s %s de %s m², %d chambre(s), cuisine équipée, '
+        u'salle d\'eau, parquet, double vitrage.' % (kind, titre.lower(),
+            ('%.2f' % surface).rstrip('0').rstrip('.'), max(rooms - 1, 1)),
+                                                          #descriptif
+        float(prix),                                      #prix
+        u'€',                                             #prixUnite
+        ad_type == '1' and u'cc' or u'',                  #prixMention
+        rooms,                                            #nbPiece
+        str(max(rooms - 1, 0)),                           #nbChambre
+        surface,                                          #surface
+        u'm²',                                            #surfaceUnite
+        u'250',                                           #idPays
+        u'France',                                        #pays
+        cp,                                               #cp
+        ville,                                            #ville
+        str(rand.randint(0, 8)),                          #nbPhotos
+        u'http://thbr.figarocms.net/images/%s/1.jpg' % annonce_id,
+                                                          #firstThumb
+        u'http://www.seloger.com/annonces/%s.htm' % annonce_id,
+                                                          #permaLien
+        round(rand.uniform(43.2, 50.7), 6),               #latitude
+        round(rand.uniform(-1.6, 7.8), 6),                #longitude
+        str(rand.choice([0, 1, 2])),                      #llPrecision
+    )
+
+def make_search(rand, owner_id, city, ad_type):
+    """returns a search (row of the searches table)"""
+    (cp, ville, weight, rent, price) = city
+    rooms = rand.choice([1, 1, 2, 2, 3, 4])
+    min_surf = rooms * rand.choice([9, 12, 15, 18])
+    if ad_type == '1':
+        max_price = int(min_surf * rent * rand.uniform(1.2, 2.5)) // 50 * 50
+    else:
+        max_price = int(min_surf * price * rand.uniform(1.2, 2.5)) \
+                // 10000 * 10000
+    min_surf = str(min_surf)
+    max_price = str(max_price)
+    search_id = md5.new(owner_id + cp + min_surf + max_price).hexdigest()
+    #a few searches were disabled by their owner
+    flag_active = rand.random() < 0.9 and '1' or '0'
+    return (search_id, owner_id, flag_active, cp, min_surf, max_price,
+            ad_type, str(rooms))
+
+def generate(backend, ads, users, seed=0, matches=200, new_ratio=0.01,
+        searches_per_user=1.5):
+    """fills the database of the backend
+    arg 1: the backend (SqliteSeLogerDB)
+    arg 2: the number of ads
+    arg 3: the number of users
+    arg 4: the seed of the random generator
+    arg 5: the maximum number of ads mapped to each search
+    arg 6: the ratio of the map rows not printed yet
+    arg 7: the average number of searches of a user
+    returns the number of map rows
+    """
+    rand = random.Random(seed)
+    now = datetime.datetime.now()
+    db = backend._getDb()
+    cursor = db.cursor()
+    keys = [(city, ad_type) for city in CITIES for ad_type in ('1', '2')]
+    #2 rents for 1 sell
+    weights = [city[2] * (ad_type == '1' and 2 or 1)
+            for (city, ad_type) in keys]
+    total = float(sum(weights))
+
+    #the searches of each (postal code, type of ad)
+    searches = dict([(key, []) for key in keys])
+    for i in range(int(users * searches_per_user)):
+        owner_id = 'user%s' % rand.randrange(users)
+        key = keys[weighted(rand, weights, total)]
+        searches[key].append(make_search(rand, owner_id, key[0], key[1]))
+    cursor.executemany("INSERT INTO searches VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [search for key in keys for search in searches[key]])
+    db.commit()
+
+    map_rows = 0
+    next_id = 80000000
+    for (key, weight) in zip(keys, weights):
+        (city, ad_type) = key
+        number = int(round(ads * weight / total))
+        results = []
+        for i in range(number):
+            results.append(make_ad(rand, str(next_id), city, ad_type, now))
+            next_id += 1
+        backend._insert_results(cursor, results)
+
+        #each search is mapped to (at most) 'matches' of the ads
+        #it would have found
+        index = backend.val_xml.index
+        values = [(ad[index('prix')], ad[index('surface')],
+            ad[index('nbPiece')], ad[index('idAnnonce')])
+            for ad in results]
+        mapping = []
+        for search in searches[key]:
+            (max_price, min_surf, nb_pieces) = (float(search[5]),
+                    float(search[4]), int(search[7]))
+            owner_id = search[1]
+            found = 0
+            start = values and rand.randrange(len(values)) or 0
+            for (prix, surface, rooms, annonce_id) in \
+                    values[start:] + values[:start]:
+                if prix <= max_price and surface >= min_surf \
+                        and rooms >= nb_pieces:
+                    flag_shown = rand.random() < new_ratio and '1' or '0'
+                    mapping.append((md5.new(owner_id + annonce_id).hexdigest(),
+                        annonce_id, flag_shown, ad_type, owner_id))
+                    found += 1
+                    if found >= matches:
+                        break
+        #(rowcount is -1 after an executemany without rows)
+        if mapping:
+            cursor.executemany("INSERT INTO map VALUES (?,?,?,?,?)", mapping)
+            map_rows += cursor.rowcount
+        db.commit()
+    #the stats of the generated ads
+    backend.rebuild_stats()
+    #the rows were inserted without the filter of the stored ads,
+    #it's built again so that it has them (it's saved by close)
+    backend._build_known(db.cursor())
+    return map_rows
+
+def weighted(rand, weights, total):
+    """index of a random element following the weights"""
+    value = rand.uniform(0, total)
+    for (i, weight) in enumerate(weights):
+        value -= weight
+        if value <= 0:
+            return i
+    return len(weights) - 1
+
+def main():
+    parser = OptionParser(usage='%prog [options] [directory]')
+    parser.add_option('--ads', type='int', default=100000)
+    parser.add_option('--users', type='int', default=1000)
+    parser.add_option('--matches', type='int', default=200,
+            help='maximum number of ads mapped to a search')
+    parser.add_option('--new-ratio', type='float', default=0.01,
+            help='ratio of the ads not printed yet')
+    parser.add_option('--seed', type='int', default=0)
+    (options, args) = parser.parse_args()
+    directory = os.path.abspath(args and args[0] or '.')
+    filename = os.path.join(directory, 'db.seloger')
+
+    if not os.path.isdir(directory):
+        parser.error('%s is not a directory' % directory)
+    if os.path.exists(filename):
+        parser.error('%s already exists' % filename)
+    logging.basicConfig(level=logging.WARNING)
+    plugin = load_plugin()
+    backend = plugin.SqliteSeLogerDB(logging.getLogger('bench'),
+            filename=filename)
+    start = time.time()
+    map_rows = generate(backend, options.ads, options.users, options.seed,
+            options.matches, options.new_ratio)
+    backend.close()
+    print '%s ads, %s users, %s map rows generated in %.1fs' % (
+            options.ads, options.users, map_rows, time.time() - start)
+
+if __name__ == '__main__':
+    main()
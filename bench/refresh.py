@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmark of a full refresh cycle against the replay server
+(see server.py), for each number of searches it times:
+
+fetch: download of a page (until the headers are received)
+parse: reading and parsing of a page
+insert: storage of a page inside the database
+get_new: collecting the new ads once the refresh is done
+
+usage: python refresh.py [--sizes 10,100,1000] [--threads 4] [...]
+"""
+
+import os
+import sys
+import time
+import shutil
+import random
+import logging
+import tempfile
+import threading
+from optparse import OptionParser
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH))
+
+from server import ReplayServer
+from fetcher import Fetcher, HttpTransport, TokenBucket
+from sandbox import load_plugin
+
+#imported by main (see sandbox.py)
+plugin = None
+
+#postal codes of the searches (a query is shared by the searches
+#with the same postal code and type of ad)
+CPS = [str(75001 + i) for i in range(20)] + \
+      [str(69001 + i) for i in range(9)] + \
+      [str(13001 + i) for i in range(16)] + \
+      ['59000', '33000', '44000', '31000', '67000']
+
+class Recorder(object):
+    """collects the durations of the phases of a refresh"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.samples = {'fetch': [], 'parse': [], 'insert': [],
+                'get_new': []}
+        self.counters = {'queries': 0, 'pages': 0, 'ads': 0, 'rows': 0}
+
+    def add(self, phase, elapsed):
+        with self.lock:
+            self.samples[phase].append(elapsed)
+
+    def count(self, counter, number):
+        with self.lock:
+            self.counters[counter] += number
+
+    def instrument(self, backend):
+        """wraps the methods of the backend doing each phase"""
+        recorder = self
+        get = backend.fetcher.get
+        fetch_page = backend._fetch_page
+        store_page = backend._store_page
+        plan_searches = backend._plan_searches
+
+        def timed_get(url, *args, **kwargs):
+            start = time.time()
+            try:
+                return get(url, *args, **kwargs)
+            finally:
+                recorder.local.fetch = time.time() - start
+
+        def timed_fetch_page(page, subscribers):
+            #the ads are yielded while the page is read, only the time
+            #spent inside the generator is counted
+            recorder.local.fetch = 0
+            ads = fetch_page(page, subscribers)
+            elapsed = 0
+            number = 0
+            while True:
+                start = time.time()
+                try:
+                    ad = ads.next()
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.time() - start
+                number += 1
+                yield ad
+            fetch = recorder.local.fetch
+            page['read'] = page.get('read', 0) + elapsed
+            recorder.add('fetch', fetch)
+            recorder.add('parse', elapsed - fetch)
+            recorder.count('pages', 1)
+            recorder.count('ads', number)
+
+        def timed_store_page(page, ads, ad_type, subscribers):
+            #with one refresh thread, the page is read while stored
+            read = page.get('read', 0)
+            start = time.time()
+            try:
+                return store_page(page, ads, ad_type, subscribers)
+            finally:
+                elapsed = time.time() - start
+                recorder.add('insert',
+                        elapsed - (page.get('read', 0) - read))
+                recorder.count('rows', page['new_rows'])
+
+        def counted_plan_searches(searches):
+            jobs = plan_searches(searches)
+            recorder.count('queries', len(jobs))
+            return jobs
+
+        backend.fetcher.get = timed_get
+        backend._fetch_page = timed_fetch_page
+        backend._store_page = timed_store_page
+        backend._plan_searches = counted_plan_searches
+
+def percentile(values, percent):
+    """nearest rank percentile of a list of values"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+def add_searches(backend, number, seed):
+    """adds the searches of the benchmark (always the same ones
+    for a given number)"""
+    rand = random.Random(seed)
+    for i in range(number):
+        ad_type = rand.choice(['1', '1', '1', '2'])
+        if ad_type == '1':
+            max_price = str(rand.randrange(800, 3000, 100))
+        else:
+            max_price = str(rand.randrange(200000, 900000, 10000))
+        backend.add_search('user%s' % i, rand.choice(CPS),
+                str(rand.choice([10, 20, 30, 40])), max_price, ad_type,
+                str(rand.choice([1, 1, 2, 3])))
+
+def report(size, cycle, wall, recorder):
+    counters = recorder.counters
+    print '%s searches, cycle %s: %s queries, %s pages, %s ads, ' \
+        '%s new rows in %.2fs (%.1f pages/s, %.1f ads/s)' % (size, cycle,
+        counters['queries'], counters['pages'], counters['ads'],
+        counters['rows'], wall, counters['pages'] / wall,
+        counters['ads'] / wall)
+    print '    %-8s %8s %10s %10s %10s %12s' % ('phase', 'count',
+            'total(s)', 'p50(ms)', 'p99(ms)', 'per second')
+    for phase in ('fetch', 'parse', 'insert', 'get_new'):
+        samples = recorder.samples[phase]
+        total = sum(samples)
+        print '    %-8s %8d %10.3f %10.2f %10.2f %12.1f' % (phase,
+            len(samples), total, percentile(samples, 50) * 1000,
+            percentile(samples, 99) * 1000,
+            total and len(samples) / total or 0.0)
+
+def run(size, options, port):
+    """plays options.cycles refreshes of size searches
+    in a new database"""
+    directory = tempfile.mkdtemp(prefix='seloger-bench-')
+    cwd = os.getcwd()
+    #the database is created in the current directory
+    os.chdir(directory)
+    try:
+        limiter = None
+        if options.rate > 0:
+            limiter = TokenBucket(options.rate, options.threads)
+        fetcher = Fetcher(HttpTransport(address=('127.0.0.1', port)),
+                limiter=limiter)
+        backend = plugin.SqliteSeLogerDB(logging.getLogger('bench'),
+                refresh_threads=options.threads,
+                coalesce_searches=not options.no_coalesce,
+                fetcher=fetcher, known_ads_cutoff=options.cutoff)
+        add_searches(backend, size, size)
+        recorder = Recorder()
+        recorder.instrument(backend)
+        for cycle in range(1, options.cycles + 1):
+            recorder.reset()
+            start = time.time()
+            backend.do_searches()
+            start_new = time.time()
+            backend.get_new()
+            end = time.time()
+            recorder.add('get_new', end - start_new)
+            report(size, cycle, end - start, recorder)
+        backend.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='10,100,1000',
+            help='numbers of searches, comma separated')
+    parser.add_option('--cycles', type='int', default=2,
+            help='refreshes played for each number of searches')
+    parser.add_option('--threads', type='int', default=4,
+            help='refresh threads')
+    parser.add_option('--latency', type='float', default=0.05,
+            help='seconds added by the server to each response')
+    parser.add_option('--jitter', type='float', default=0.0,
+            help='random seconds (up to) added to each response')
+    parser.add_option('--rate', type='float', default=0,
+            help='requests per second (0 -> no limit)')
+    parser.add_option('--cutoff', type='int', default=0,
+            help='consecutive known ads stopping a search (0 -> off)')
+    parser.add_option('--no-coalesce', action='store_true', default=False,
+            help='one query per search')
+    parser.add_option('--verbose', action='store_true', default=False)
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=options.verbose and logging.INFO
+            or logging.WARNING)
+    global plugin
+    plugin = load_plugin()
+    server = ReplayServer(latency=options.latency, jitter=options.jitter)
+    port = server.start()
+    try:
+        for size in options.sizes.split(','):
+            run(int(size), options, port)
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+import of the plugin by the benchmarks: supybot creates its directories
+(conf/ and logs/ when imported, backup/ data/ and tmp/ when the program
+ends) inside the current directory, the plugin is imported from a
+temporary directory which stays the current directory until the end
+"""
+
+import os
+import sys
+import shutil
+import atexit
+import tempfile
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH))
+
+def load_plugin():
+    """changes the current directory to a temporary one (removed when
+    the program ends) and imports the plugin from there
+    returns the plugin module
+    """
+    directory = tempfile.mkdtemp(prefix='seloger-supybot-')
+    #registered before the handlers of supybot, so it runs after them
+    atexit.register(shutil.rmtree, directory, True)
+    os.chdir(directory)
+    import plugin
+    return plugin
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmark of the queries on databases of growing size filled by
+generate.py, for each size it times get_new, get_all, get_search
+and the slstatrent/slstatbuy commands
+
+usage: python scale.py [--sizes 10000:100,100000:1000,1000000:10000]
+"""
+
+import os
+import sys
+import time
+import shutil
+import random
+import logging
+import tempfile
+from optparse import OptionParser
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH))
+
+from generate import generate, CITIES
+from refresh import percentile
+from sandbox import load_plugin
+from pyasciigraph import Pyasciigraph
+
+#imported by main (see sandbox.py)
+plugin = None
+
+class FakeIrc(object):
+    """counts the lines the commands reply"""
+
+    def __init__(self):
+        self.lines = 0
+
+    def reply(self, msg, to=None, private=False):
+        self.lines += 1
+
+def stat_plugin(backend):
+    """a SeLoger plugin using backend, without the supybot initialisation"""
+    seloger = plugin.SeLoger.__new__(plugin.SeLoger)
+    seloger.backend = backend
+    seloger.graph = Pyasciigraph()
+    return seloger
+
+def slstat(seloger, user, irc, pc, ad_type):
+    """what slstatrent (ad_type '1') and slstatbuy (ad_type '2') do"""
+    seloger._gen_stats(user, irc, pc, ad_type)
+
+def timed(samples, function, *args):
+    start = time.time()
+    result = function(*args)
+    samples.append(time.time() - start)
+    return result
+
+def run(ads, users, options):
+    """generates a database of ads and users and times the queries"""
+    directory = tempfile.mkdtemp(prefix='seloger-scale-')
+    cwd = os.getcwd()
+    #the database is created in the current directory
+    os.chdir(directory)
+    try:
+        backend = plugin.SqliteSeLogerDB(logging.getLogger('bench'))
+        start = time.time()
+        map_rows = generate(backend, ads, users, options.seed,
+                options.matches, options.new_ratio)
+        print '%s ads, %s users, %s map rows (%.1f MB) generated in %.1fs' % (
+                ads, users, map_rows,
+                os.path.getsize('db.seloger') / 1024.0 / 1024.0,
+                time.time() - start)
+
+        db = backend._getDb()
+        db.row_factory = backend._record_factory
+        cursor = db.cursor()
+        cursor.execute("SELECT rowid FROM map WHERE flag_shown = 1")
+        new_rows = [row['rowid'] for row in cursor.fetchall()]
+
+        rand = random.Random(options.seed)
+        samples = dict([(query, []) for query in ('get_new', 'get_all',
+            'get_all cp', 'get_search', 'slstatrent', 'slstatbuy')])
+        returned = dict([(query, 0) for query in samples])
+        seloger = stat_plugin(backend)
+        for i in range(options.repeat):
+            #the same ads are new again for each get_new
+            cursor = db.cursor()
+            cursor.executemany("UPDATE map SET flag_shown = 1 WHERE rowid = ?",
+                    [(rowid, ) for rowid in new_rows])
+            db.commit()
+            returned['get_new'] += len(timed(samples['get_new'],
+                backend.get_new))
+
+            user = 'user%s' % rand.randrange(users)
+            searches = timed(samples['get_search'], backend.get_search, user)
+            returned['get_search'] += len(searches)
+            #a postal code the user searches in, if any
+            cp = searches and rand.choice(searches)['cp'] or \
+                    rand.choice(CITIES)[0]
+            returned['get_all'] += len(timed(samples['get_all'],
+                backend.get_all, user, 'all', '1'))
+            returned['get_all cp'] += len(timed(samples['get_all cp'],
+                backend.get_all, user, cp, '1'))
+            for (command, ad_type) in (('slstatrent', '1'),
+                    ('slstatbuy', '2')):
+                irc = FakeIrc()
+                timed(samples[command], slstat, seloger, user, irc, 'all',
+                        ad_type)
+                returned[command] += irc.lines
+
+        print '    %-12s %8s %10s %10s %10s' % ('query', 'calls',
+                'p50(ms)', 'p99(ms)', 'rows')
+        for query in ('get_new', 'get_all', 'get_all cp', 'get_search',
+                'slstatrent', 'slstatbuy'):
+            print '    %-12s %8d %10.2f %10.2f %10.1f' % (query,
+                len(samples[query]), percentile(samples[query], 50) * 1000,
+                percentile(samples[query], 99) * 1000,
+                returned[query] / float(options.repeat))
+        backend.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='10000:100,100000:1000,1000000:10000',
+            help='<ads>:<users> of each database, comma separated')
+    parser.add_option('--repeat', type='int', default=5,
+            help='calls of each query')
+    parser.add_option('--matches', type='int', default=200,
+            help='maximum number of ads mapped to a search')
+    parser.add_option('--new-ratio', type='float', default=0.01,
+            help='ratio of the ads not printed yet')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--verbose', action='store_true', default=False)
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=options.verbose and logging.INFO
+            or logging.WARNING)
+    global plugin
+    plugin = load_plugin()
+    for size in options.sizes.split(','):
+        (ads, users) = size.split(':')
+        run(int(ads), int(users), options)
+
+if __name__ == '__main__':
+    main()
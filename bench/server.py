@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+local http server replaying the recorded search.xml pages of fixtures/
+in place of ws.seloger.com, each query (postal code and type of ad)
+gets its own ads (the ids, postal code and prices of the recorded pages
+are rewritten) and the pages follow each other like on seloger.com
+
+usage: python server.py [--port 8080] [--latency 0.05]
+"""
+
+import os
+import re
+import time
+import random
+import md5
+import datetime
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+DATE = re.compile(r'<(dtCreation|dtFraicheur)>([^<]*)</')
+ID = re.compile(r'<idAnnonce>([^<]*)</')
+CP = re.compile(r'<cp>[^<]*</')
+PRICE = re.compile(r'<prix>([^<]*)</')
+NEXT = re.compile(r'<pageSuivante>[^<]*</')
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        query = urlparse.urlparse(self.path).query
+        params = urlparse.parse_qs(query)
+        try:
+            body = server.page(params['cp'][0],
+                    params.get('idtt', ['1'])[0],
+                    int(params.get('SEARCHpg', ['1'])[0]),
+                    query.split('&SEARCHpg=')[0])
+        except (KeyError, ValueError):
+            body = None
+        server.hit()
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"%s"' % md5.new(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """serves the fixtures pages
+    arg 1: the (host, port) to listen on (port 0 -> any free port)
+    arg 2: the latency (in seconds) added to each response
+    arg 3: a random delay (in seconds) between 0 and jitter added too
+    arg 4: the directory of the recorded pages (search-<page>.xml)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0,
+            fixtures=FIXTURES):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReplayHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.rendered = {}
+        self.pages = []
+        names = [name for name in os.listdir(fixtures)
+                if name.startswith('search-') and name.endswith('.xml')]
+        names.sort(key=lambda name: int(name[7:-4]))
+        for name in names:
+            self.pages.append(open(os.path.join(fixtures, name)).read())
+
+        #the recorded dates are moved so that the newest ad is from now
+        newest = max([date for page in self.pages
+            for (tag, date) in DATE.findall(page)])
+        self.shift = datetime.datetime.now() - \
+                datetime.datetime.strptime(newest, DATE_FORMAT)
+
+    def hit(self):
+        with self.lock:
+            self.requests += 1
+
+    def page(self, cp, ad_type, number, query):
+        """returns the body of a page, None if it doesn't exist
+        arg 1: the postal code searched
+        arg 2: type of the ads (1 -> location, 2 -> sell)
+        arg 3: the number of the page (from 1)
+        arg 4: the query string of the search (without the page number)
+        """
+        if number < 1 or number > len(self.pages):
+            return None
+        key = (cp, ad_type, number, query)
+        with self.lock:
+            if key in self.rendered:
+                return self.rendered[key]
+        body = self.pages[number - 1]
+        #each query has its own ads
+        prefix = str(int(cp) * 10 + int(ad_type))
+        body = ID.sub(lambda m: '<idAnnonce>%s%s</' % (prefix, m.group(1)),
+                body)
+        body = CP.sub('<cp>%s</' % cp, body)
+        body = DATE.sub(lambda m: '<%s>%s</' % (m.group(1),
+            (datetime.datetime.strptime(m.group(2), DATE_FORMAT) +
+                self.shift).strftime(DATE_FORMAT)), body)
+        if ad_type == '2':
+            body = PRICE.sub(lambda m: '<prix>%d</' %
+                    (int(m.group(1)) * 250), body)
+        body = NEXT.sub('<pageSuivante>http://ws.seloger.com/search.xml?'
+                '%s&amp;SEARCHpg=%d</' % (query.replace('&', '&amp;'),
+                    number + 1), body)
+        with self.lock:
+            self.rendered[key] = body
+        return body
+
+    def start(self):
+        """serves in a background thread, returns the port"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--latency', type='float', default=0.05,
+            help='seconds added to each response')
+    parser.add_option('--jitter', type='float', default=0.0,
+            help='random seconds (up to) added to each response')
+    (options, args) = parser.parse_args()
+    server = ReplayServer(('127.0.0.1', options.port), options.latency,
+            options.jitter)
+    print 'replaying %s pages on port %s' % (len(server.pages), options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import math
+import json
+import struct
+import hashlib
+
+#the two hashes taken from the md5 digest of a string
+HASHES = struct.Struct('<II')
+
+class BloomFilter(object):
+    """probabilistic set of strings: a string added is always found,
+    a string never added is found with a probability of about 'error'
+    (as long as no more than 'capacity' strings are added)
+    """
+
+    def __init__(self, capacity, error=0.01):
+        """constructor of BloomFilter
+        arg1: the number of strings expected
+        arg2: the rate of false positives expected
+        """
+        self.capacity = capacity
+        self.error = error
+        self.size = int(math.ceil(-capacity * math.log(error) /
+            math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) *
+            math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        #number of strings added
+        self.count = 0
+
+    def _hashes(self, key):
+        """returns the two hashes of a string the positions of its bits 
+        are made of (double hashing: first + i * second)"""
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        #32 bits integers, the products stay small
+        (first, second) = HASHES.unpack_from(hashlib.md5(key).digest())
+        return (first, second | 1)
+
+    def add(self, key):
+        (first, second) = self._hashes(key)
+        size = self.size
+        bits = self.bits
+        for i in xrange(self.hashes):
+            position = (first + i * second) % size
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        (first, second) = self._hashes(key)
+        size = self.size
+        bits = self.bits
+        for i in xrange(self.hashes):
+            position = (first + i * second) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def save(self, filename, marks=None):
+        """writes the filter in a file (replaced atomically)
+        arg1: the name of the file
+        arg2: a dictionnary saved with the filter (see load)
+        """
+        header = json.dumps({
+            'capacity': self.capacity,
+            'error': self.error,
+            'count': self.count,
+            'marks': marks or {},
+            })
+        temporary = filename + '.tmp'
+        with open(temporary, 'wb') as output:
+            output.write(header + '\n')
+            output.write(self.bits)
+        os.rename(temporary, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """reads a filter written by save
+        arg1: the name of the file
+        returns (the filter, the dictionnary saved with it),
+        raises IOError or ValueError if the file is missing or invalid
+        """
+        with open(filename, 'rb') as input:
+            header = json.loads(input.readline())
+            bits = input.read()
+        try:
+            bloom = cls(header['capacity'], header['error'])
+            bloom.count = header['count']
+            marks = header['marks']
+        except (KeyError, TypeError):
+            raise ValueError('invalid bloom filter %s' % filename)
+        if len(bits) != len(bloom.bits):
+            raise ValueError('truncated bloom filter %s' % filename)
+        bloom.bits = bytearray(bits)
+        return (bloom, marks)
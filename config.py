@@ -44,6 +44,56 @@ SeLoger = conf.registerPlugin('SeLoger')
 # This is where your configuration variables (if any) should go.  For example:
 # conf.registerGlobalValue(SeLoger, 'someConfigVariableName',
 #     registry.Boolean(False, """Help for someConfigVariableName."""))
+conf.registerGlobalValue(SeLoger, 'refreshInterval',
+    registry.PositiveInteger(300, """Minimum time (in seconds) between two
+    refreshes of a search. The searches bringing many new ads are refreshed
+    this often."""))
+conf.registerGlobalValue(SeLoger, 'maxRefreshInterval',
+    registry.PositiveInteger(3600, """Maximum time (in seconds) between two
+    refreshes of a search. The searches bringing no new ads are refreshed
+    this often."""))
+conf.registerGlobalValue(SeLoger, 'refreshThreads',
+    registry.PositiveInteger(4, """Number of threads downloading and parsing
+    the seloger.com pages during a refresh (1 plays the searches one after
+    another)."""))
+conf.registerGlobalValue(SeLoger, 'coalesceSearches',
+    registry.Boolean(True, """Determines whether the searches on the same
+    postal code and type of ad are merged into one query to seloger.com, the
+    price, surface and rooms of each search being then checked by the bot.
+    If False, only identical searches are merged."""))
+conf.registerGlobalValue(SeLoger, 'connectTimeout',
+    registry.PositiveInteger(10, """Timeout (in seconds) for opening a
+    connection to seloger.com."""))
+conf.registerGlobalValue(SeLoger, 'readTimeout',
+    registry.PositiveInteger(30, """Timeout (in seconds) for receiving data
+    from seloger.com."""))
+conf.registerGlobalValue(SeLoger, 'fetchRetries',
+    registry.NonNegativeInteger(2, """Number of retries when a page could not
+    be downloaded, the delay between two retries doubles each time."""))
+conf.registerGlobalValue(SeLoger, 'requestsPerSecond',
+    registry.PositiveFloat(2.0, """Maximum number of requests per second sent
+    to seloger.com by all the refresh threads together."""))
+conf.registerGlobalValue(SeLoger, 'requestsBurst',
+    registry.PositiveInteger(4, """Maximum number of requests sent to
+    seloger.com at once, before being limited to requestsPerSecond."""))
+conf.registerGlobalValue(SeLoger, 'cacheTTL',
+    registry.NonNegativeInteger(86400, """Time (in seconds) a downloaded page
+    is kept in the cache when it's not used anymore. The cached pages are
+    revalidated with seloger.com, and are not parsed again when they didn't
+    change. 0 disables the cache."""))
+conf.registerGlobalValue(SeLoger, 'cacheSize',
+    registry.PositiveInteger(50, """Maximum size (in MB) of the cache of
+    downloaded pages."""))
+conf.registerGlobalValue(SeLoger, 'knownAdsCutoff',
+    registry.NonNegativeInteger(0, """Stops downloading the next pages of a
+    search after this number of consecutive ads already known (already
+    stored for its owners, too old, or not more recent than the newest ad
+    stored for this search). 0 always downloads every page."""))
+conf.registerGlobalValue(SeLoger, 'retentionDays',
+    registry.NonNegativeInteger(60, """Deletes the ads created more than this
+    number of days ago (never less than 31 days, the age of the oldest ads
+    downloaded), and the ads of the users without active search, between
+    the refreshes. 0 keeps everything."""))
 
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
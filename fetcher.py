@@ -0,0 +1,653 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import httplib
+import urlparse
+import socket
+import threading
+import time
+import hashlib
+import json
+import StringIO
+
+class FetchError(Exception):
+    """raised when a page could not be downloaded"""
+    pass
+
+class ConnectError(socket.error):
+    """raised by HttpTransport when a connection to the server could
+    not be opened"""
+    pass
+
+class Response(object):
+    """the result of a request
+    status: the http status code
+    headers: dictionnary of the headers (lower case names)
+    body: the content of the page (None if the response is streamed)
+    unchanged: True if the page is the same as the cached one
+    """
+
+    def __init__(self, status, headers, body, stream=None, release=None):
+        """constructor of Response
+        arg1: the http status code
+        arg2: dictionnary of the headers
+        arg3: the content of the page
+        arg4: for a streamed response, file like object reading the 
+              content from the network
+        arg5: for a streamed response, function called by close()
+        """
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.stream = stream
+        self.release = release
+        self.unchanged = False
+
+    def open(self):
+        """returns a file like object reading the content"""
+        if self.stream is not None:
+            return self.stream
+        return StringIO.StringIO(self.body)
+
+    def close(self):
+        """must be called when a streamed response is not used anymore"""
+        if self.release is not None:
+            self.release()
+            self.release = None
+
+class CacheEntry(object):
+    """a response stored in the cache"""
+
+    def __init__(self, meta, body):
+        self.url = meta['url']
+        self.etag = meta.get('etag')
+        self.last_modified = meta.get('last_modified')
+        self.digest = meta['digest']
+        self.headers = meta.get('headers', {})
+        self.body = body
+
+class ResponseCache(object):
+    """on disk cache of the responses, keyed by url,
+    one file per url (a json line of metadata followed by the body)
+    """
+
+    def __init__(self, directory, ttl=86400, max_size=50 * 1024 * 1024):
+        """constructor of ResponseCache
+        arg1: the directory of the cache (created if needed)
+        arg2: time (in seconds) after which an unused entry is removed
+        arg3: maximum size (in bytes) of the cache, the least
+              recently used entries are removed above it
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        #key -> (last use, size)
+        self.entries = {}
+        self.size = 0
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            self.entries[name] = (stat.st_mtime, stat.st_size)
+            self.size += stat.st_size
+        with self.lock:
+            self._evict()
+
+    def _key(self, url):
+        return hashlib.md5(url).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _remove(self, key):
+        """removes an entry, the lock must be held"""
+        (last_use, size) = self.entries.pop(key)
+        self.size -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        """removes the expired entries, then the least recently used
+        ones until the cache fits in max_size, the lock must be held
+        """
+        limit = time.time() - self.ttl
+        for key in [k for (k, (last_use, size)) in self.entries.items()
+                if last_use < limit]:
+            self._remove(key)
+        if self.size <= self.max_size:
+            return
+        for key in sorted(self.entries, key=lambda k: self.entries[k][0]):
+            self._remove(key)
+            if self.size <= self.max_size:
+                return
+
+    def _read(self, key, body=True):
+        """reads the metadata and the body of an entry,
+        the lock must be held
+        arg1: the key of the entry
+        arg2: if False, only the metadata is read (the body is None)
+        returns (metadata, body), None if the file is not readable
+        """
+        try:
+            f = open(self._path(key), 'rb')
+            try:
+                meta = json.loads(f.readline())
+                if body:
+                    return (meta, f.read())
+                return (meta, None)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            self._remove(key)
+            return None
+
+    def _touch(self, key):
+        """marks an entry as used now, the lock must be held"""
+        self.entries[key] = (time.time(), self.entries[key][1])
+        try:
+            os.utime(self._path(key), None)
+        except OSError:
+            pass
+
+    def get(self, url):
+        """returns the CacheEntry of url, None if not in the cache"""
+        key = self._key(url)
+        with self.lock:
+            if key not in self.entries:
+                return None
+            if self.entries[key][0] < time.time() - self.ttl:
+                self._remove(key)
+                return None
+            read = self._read(key)
+        if read is None:
+            return None
+        (meta, body) = read
+        if meta.get('url') != url:
+            return None
+        return CacheEntry(meta, body)
+
+    def put(self, url, response):
+        """stores the response of url, the file of the entry is not
+        written again if the response didn't change"""
+        key = self._key(url)
+        meta = {
+            'url': url,
+            'etag': response.headers.get('etag'),
+            'last_modified': response.headers.get('last-modified'),
+            'headers': response.headers,
+            'digest': hashlib.md5(response.body).hexdigest(),
+            }
+        path = self._path(key)
+        with self.lock:
+            #the same response: only the time of use changes
+            if key in self.entries:
+                read = self._read(key, False)
+                if read is not None and all([read[0].get(name) ==
+                        meta[name] for name in ('url', 'digest', 'etag',
+                            'last_modified')]):
+                    self._touch(key)
+                    return
+            tmp = path + '.tmp'
+            f = open(tmp, 'wb')
+            try:
+                f.write(json.dumps(meta) + '\n')
+                f.write(response.body)
+            finally:
+                f.close()
+            os.rename(tmp, path)
+            if key in self.entries:
+                self.size -= self.entries[key][1]
+            size = os.path.getsize(path)
+            self.entries[key] = (time.time(), size)
+            self.size += size
+            self._evict()
+
+    def touch(self, url):
+        """marks the entry of url as used now"""
+        key = self._key(url)
+        with self.lock:
+            if key in self.entries:
+                self._touch(key)
+
+class HttpTransport(object):
+    """http transport keeping the connections alive: the idle 
+    connections to each host are kept in a pool, a request takes one 
+    (or opens one) and gives it back once its response is read.
+    a request on an idle connection closed by the server meanwhile is 
+    sent again on a new connection.
+    """
+
+    def __init__(self, connect_timeout=10, read_timeout=30, address=None):
+        """constructor of HttpTransport
+        arg1: timeout (in seconds) for opening a connection
+        arg2: timeout (in seconds) for each read on the socket
+        arg3: optional (host, port) to connect to instead of the host
+              of the urls (used to play the requests on a local server)
+        """
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.address = address
+        #(scheme, netloc) -> list of the idle connections
+        self.idle = {}
+        #every connection opened, so close() can close them all
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
+    def _checkout(self, key, reuse=True):
+        """takes an idle connection to a host from the pool,
+        opening one if there is none
+        arg1: (scheme, netloc)
+        arg2: if False, a new connection is opened anyway
+        returns (connection, True if it was taken from the pool)
+        """
+        if reuse:
+            with self.connections_lock:
+                idle = self.idle.get(key)
+                if idle:
+                    return (idle.pop(), True)
+
+        (scheme, netloc) = key
+        if self.address is not None:
+            host, port = self.address
+        else:
+            host, port = netloc, None
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port,
+                    timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port,
+                    timeout=self.connect_timeout)
+        try:
+            conn.connect()
+        except socket.error, e:
+            raise ConnectError(*e.args)
+        #once connected, we wait at most read_timeout for each read
+        conn.sock.settimeout(self.read_timeout)
+
+        with self.connections_lock:
+            self.connections.add(conn)
+        return (conn, False)
+
+    def _checkin(self, key, conn):
+        """gives a connection back to the pool"""
+        with self.connections_lock:
+            if conn in self.connections:
+                self.idle.setdefault(key, []).append(conn)
+                return
+        #the transport was closed meanwhile
+        conn.close()
+
+    def _drop(self, conn):
+        """closes and forgets a connection"""
+        conn.close()
+        with self.connections_lock:
+            self.connections.discard(conn)
+
+    def _stale(self, error):
+        """tells if the error of a request sent on a connection of the
+        pool means the server closed it before the request was read
+        """
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return isinstance(error, socket.error) and \
+                error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+    def request(self, url, headers, stream=False):
+        """does a GET request on url
+        arg1: the url
+        arg2: dictionnary of additional headers
+        arg3: if True, the content of a 200 response is not read,
+              it's read from the network with response.open()
+        returns a Response, raises socket.error (ConnectError if the 
+        server could not be reached) or httplib.HTTPException
+        """
+        parsed = urlparse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = path + '?' + parsed.query
+        headers = dict(headers)
+        headers['Host'] = parsed.netloc
+        key = (parsed.scheme, parsed.netloc)
+
+        (conn, reused) = self._checkout(key)
+        try:
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                if not reused or not self._stale(e):
+                    raise
+                #the server closed the idle connection meanwhile, the
+                #request is sent again on a new one
+                self._drop(conn)
+                (conn, reused) = self._checkout(key, False)
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            if stream and resp.status == 200:
+                return Response(resp.status, dict(resp.getheaders()), None,
+                        resp, lambda: self._release(resp, key, conn))
+            body = resp.read()
+        except (socket.error, httplib.HTTPException):
+            #the connection is in an unknown state, we don't reuse it
+            self._drop(conn)
+            raise
+
+        if resp.will_close:
+            self._drop(conn)
+        else:
+            self._checkin(key, conn)
+        return Response(resp.status, dict(resp.getheaders()), body)
+
+    def _release(self, resp, key, conn):
+        """end of a streamed response, the connection is reused only
+        if the whole content was read
+        """
+        if resp.will_close or not resp.isclosed():
+            self._drop(conn)
+        else:
+            self._checkin(key, conn)
+
+    def close(self):
+        """closes all the connections, the requests in progress
+        in other threads fail at once
+        """
+        with self.connections_lock:
+            for conn in self.connections:
+                if conn.sock is not None:
+                    try:
+                        conn.sock.shutdown(socket.SHUT_RDWR)
+                    except socket.error:
+                        pass
+                conn.close()
+            self.connections = set()
+            self.idle = {}
+
+class TokenBucket(object):
+    """limits the rate of the requests of all the threads together:
+    a request takes a token, the tokens come back at 'rate' per second,
+    and up to 'burst' tokens can be saved. each consecutive error halves
+    the rate (down to one request every max_backoff seconds) and each 
+    success doubles it back (up to 'rate').
+    """
+
+    def __init__(self, rate, burst, max_backoff=300):
+        """constructor of TokenBucket
+        arg1: the number of requests per second
+        arg2: the maximum number of requests sent at once
+        arg3: maximum delay (in seconds) between two requests after 
+              errors
+        """
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.min_rate = min(self.rate, 1.0 / max_backoff)
+        #the rate lowered by the errors
+        self.current = self.rate
+        self.tokens = float(self.burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+        #metrics
+        self.waiting = 0
+        self.max_waiting = 0
+        self.acquired = 0
+        self.delayed = 0
+        self.wait_time = 0.0
+        self.failures = 0
+        #set by stop, interrupts the waits
+        self.stopped = threading.Event()
+
+    def _refill(self, now):
+        """adds the tokens earned since the last call, the lock must be held"""
+        self.tokens = min(self.burst, 
+                self.tokens + (now - self.last) * self.current)
+        self.last = now
+
+    def acquire(self):
+        """waits until a request can be sent, raises FetchError
+        if stop is called meanwhile
+        """
+        start = time.time()
+        waited = False
+        while True:
+            with self.lock:
+                now = time.time()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.acquired += 1
+                    if waited:
+                        self.delayed += 1
+                        self.wait_time += now - start
+                    return
+                delay = (1 - self.tokens) / self.current
+                #only the requests which block are counted as waiting
+                self.waiting += 1
+                self.max_waiting = max(self.max_waiting, self.waiting)
+            try:
+                self.stopped.wait(delay)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+            waited = True
+            if self.stopped.isSet():
+                raise FetchError('stopped while waiting for a token')
+
+    def failure(self):
+        """a request failed, the rate is halved and the saved tokens 
+        are dropped"""
+        with self.lock:
+            self.failures += 1
+            self._refill(time.time())
+            self.current = max(self.min_rate, self.current / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def success(self):
+        """a request succeeded, the rate is doubled back"""
+        with self.lock:
+            self._refill(time.time())
+            self.current = min(self.rate, self.current * 2)
+
+    def stop(self):
+        """wakes up the requests waiting, and refuses the next ones"""
+        self.stopped.set()
+
+    def stats(self):
+        """returns a dictionnary with the metrics of the limiter:
+        waiting: the number of requests waiting now
+        max_waiting: the maximum number of requests waiting at once
+        acquired: the number of requests allowed
+        delayed: the number of requests which had to wait
+        wait_time: the total time (in seconds) spent waiting
+        failures: the number of failures reported
+        rate: the current rate (in requests per second)
+        """
+        with self.lock:
+            return {
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'acquired': self.acquired,
+                'delayed': self.delayed,
+                'wait_time': self.wait_time,
+                'failures': self.failures,
+                'rate': self.current,
+                }
+
+class Fetcher(object):
+    """downloads pages through a transport, with retries
+    and counts the requests and the time they took
+    """
+
+    def __init__(self, transport=None, retries=2, backoff=1,
+            max_redirects=3, cache=None, limiter=None):
+        """constructor of Fetcher
+        arg1: the transport (any object with request(url, headers, 
+              stream) and close() methods, see HttpTransport),
+              a HttpTransport by default
+        arg2: the number of retries after a failed request
+        arg3: delay (in seconds) before the first retry,
+              doubled at each retry
+        arg4: the maximum number of redirections followed
+        arg5: optional ResponseCache, used to revalidate the pages
+              (with ETag/Last-Modified) and to detect unchanged pages
+        arg6: optional TokenBucket, taken before each request
+        """
+        if transport is None:
+            transport = HttpTransport()
+        self.transport = transport
+        self.cache = cache
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.max_redirects = max_redirects
+        #metrics (see stats)
+        self.requests = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        self.max_elapsed = 0.0
+        self.lock = threading.Lock()
+        #set by stop, interrupts the waits between the retries
+        self.stopped = threading.Event()
+
+    def _record(self, url, status, elapsed):
+        """counts a request, status is None if it failed"""
+        with self.lock:
+            self.requests += 1
+            if status is None:
+                self.errors += 1
+            self.elapsed += elapsed
+            self.max_elapsed = max(self.max_elapsed, elapsed)
+
+    def stats(self):
+        """returns a dictionnary with the metrics of the requests sent 
+        since the last call:
+        requests: the number of requests
+        errors: the number of requests which failed (network errors)
+        elapsed: the total time (in seconds) taken by the requests
+        max_elapsed: the longest request (in seconds)
+        """
+        with self.lock:
+            stats = {
+                'requests': self.requests,
+                'errors': self.errors,
+                'elapsed': self.elapsed,
+                'max_elapsed': self.max_elapsed,
+                }
+            self.requests = 0
+            self.errors = 0
+            self.elapsed = 0.0
+            self.max_elapsed = 0.0
+        return stats
+
+    def _request(self, url, headers, stream):
+        """one attempt, following the redirections"""
+        for redirect in range(self.max_redirects + 1):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            start = time.time()
+            try:
+                response = self.transport.request(url, headers, stream)
+            except (socket.error, httplib.HTTPException), e:
+                self._record(url, None, time.time() - start)
+                #only a server which can't be reached slows down the
+                #requests, not a connection broken on our side
+                if self.limiter is not None and isinstance(e, ConnectError):
+                    self.limiter.failure()
+                raise FetchError('%s: %s' % (url, e))
+            self._record(url, response.status, time.time() - start)
+
+            if self.limiter is not None:
+                if response.status >= 500 or response.status == 429:
+                    self.limiter.failure()
+                else:
+                    self.limiter.success()
+
+            if response.status in (301, 302, 303, 307) \
+                    and 'location' in response.headers:
+                url = urlparse.urljoin(url, response.headers['location'])
+                continue
+            return response
+        raise FetchError('%s: too many redirections' % url)
+
+    def get(self, url, headers={}, stream=False):
+        """downloads url, retrying on network and server errors
+        arg1: the url
+        arg2: dictionnary of additional headers
+        arg3: if True and there is no cache, the content is not 
+              downloaded in advance but read with response.open()
+              (response.close() must then be called)
+        returns a Response, raises FetchError if it failed,
+        response.unchanged is True if the page is the same as the
+        cached one
+        """
+        if self.cache is None:
+            return self._get(url, headers, stream)
+
+        entry = self.cache.get(url)
+        if entry is not None:
+            headers = dict(headers)
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+        response = self._get(url, headers, False)
+
+        if response.status == 304 and entry is not None:
+            #not modified, we serve the cached page
+            self.cache.touch(url)
+            response = Response(200, entry.headers, entry.body)
+            response.unchanged = True
+            return response
+
+        if entry is not None and \
+                entry.digest == hashlib.md5(response.body).hexdigest():
+            response.unchanged = True
+        self.cache.put(url, response)
+        return response
+
+    def _get(self, url, headers, stream):
+        """downloads url, without the cache"""
+        delay = self.backoff
+        attempt = 0
+        while True:
+            if self.stopped.isSet():
+                raise FetchError('%s: stopped' % url)
+            try:
+                response = self._request(url, headers, stream)
+            except FetchError, e:
+                error = e
+            else:
+                if response.status < 400:
+                    return response
+                error = FetchError('%s: http status %s' %
+                        (url, response.status))
+                #client errors won't get better by retrying
+                if response.status < 500 and response.status != 429:
+                    raise error
+            if attempt >= self.retries:
+                raise error
+            attempt += 1
+            self.stopped.wait(delay)
+            delay = delay * 2
+
+    def stop(self):
+        """interrupts the requests in progress (from any thread): 
+        they raise FetchError at once, and so do the next ones
+        """
+        self.stopped.set()
+        if self.limiter is not None:
+            self.limiter.stop()
+        self.transport.close()
+
+    def close(self):
+        """closes the connections of the transport"""
+        self.transport.close()
@@ -28,16 +28,28 @@
 ###
 
 from pyasciigraph import Pyasciigraph 
+from fetcher import Fetcher, HttpTransport, ResponseCache, TokenBucket
+from fetcher import FetchError
+from scheduler import RefreshScheduler, AdaptivePoller
+from record import RecordFactory
+from bloom import BloomFilter
 import os
 import time
 from lxml import etree
 import threading
+import Queue
 import md5
 import unicodedata
 import datetime
+import calendar
 import itertools
 import re
+import zlib
+import json
+import socket
+import httplib
 import supybot.utils as utils
+import supybot.conf as conf
 import supybot.ircdb as ircdb
 from supybot.commands import *
 import supybot.plugins as plugins
@@ -46,16 +58,73 @@ import supybot.callbacks as callbacks
 import supybot.ircmsgs as ircmsgs
 import supybot.world as world
 
+#the ads we don't want (life annuity sales)
+VIAGER_DESCRIPTION = re.compile(r'[Vv]iager')
+VIAGER_LINK = re.compile(r'/viagers/')
+#the dates of seloger ('YYYY-MM-DDTHH:MM:SS')
+SELOGER_DATE = re.compile(
+        r'(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2}))?)?')
+
 class SqliteSeLogerDB(object):
     """This Class is the backend of the plugin,
     it handles the database, its creation, its updates,
     it also provides methods to get the ads information
     """
 
-    def __init__(self, log, filename='db.seloger'):
-        self.dbs = ircutils.IrcDict()
-        self.filename = filename
+    def __init__(self, log, filename='db.seloger', refresh_threads=1,
+            coalesce_searches=True, fetcher=None, known_ads_cutoff=0,
+            poller=None, retention_days=0):
+        #thread -> its connexion to the database
+        self.dbs = {}
+        self.dbs_lock = threading.Lock()
+        #set once the schema of the database is up to date
+        self.migrated = False
+        self.filename = os.path.abspath(filename)
         self.log = log
+        #number of threads downloading the pages during a refresh
+        self.refresh_threads = refresh_threads
+        #merge the searches on the same postal code in one query
+        self.coalesce_searches = coalesce_searches
+        #the component downloading the pages
+        if fetcher is None:
+            fetcher = Fetcher()
+        self.fetcher = fetcher
+        #url -> (next url, subscribers, url of the first page of the
+        #search) of the pages already stored
+        self.stored_pages = {}
+        #set when the plugin dies, the refresh stops as soon as possible
+        self.stopped = threading.Event()
+        #held while the ads or the stats are written
+        self.write_lock = threading.Lock()
+        #the pagination of a search stops after this number of consecutive
+        #known ads (0: never)
+        self.known_ads_cutoff = known_ads_cutoff
+        #the ads created more than max_age_days ago are not inserted
+        self.max_age_days = 30
+        #the ads are deleted retention_days after their creation 
+        #(0: never, it's at least max_age_days + 1)
+        self.retention_days = retention_days
+        #number of rows deleted in each transaction of the pruning
+        self.prune_batch = 500
+        #the owners who disabled a search since their map rows were
+        #pruned (None: every owner, they are all checked once at start)
+        self.pruned_owners = None
+        #number of free pages given back by each incremental vacuum
+        self.vacuum_pages = 1000
+        #the idAnnonce of results and the uniq_id of map already stored
+        #(probably), kept in memory and saved in known_filename
+        self.known = None
+        self.known_filename = self.filename + '.known'
+        #(number of ids, marks) of the filter saved in known_filename,
+        #None if the filter in memory was never saved
+        self.known_saved = None
+        #minimum capacity and rate of false positives of known
+        self.known_capacity = 100000
+        self.known_error = 0.01
+        #decides when each search is played (by default, at each refresh)
+        if poller is None:
+            poller = AdaptivePoller()
+        self.poller = poller
         #the elements we get from the xml
         self.val_xml = (
             'idTiers', 
@@ -88,48 +157,226 @@ class SqliteSeLogerDB(object):
             'llPrecision'
         ) 
         self.val_xml_count = len(self.val_xml)
+        #the columns of the results table which are not TEXT, 
+        #the dates are stored as seconds since the epoch (taking
+        #the time of seloger as UTC)
+        self.val_types = {
+            'dtFraicheur': 'INTEGER',
+            'dtCreation': 'INTEGER',
+            'prix': 'REAL',
+            'nbPiece': 'INTEGER',
+            'surface': 'REAL',
+            'latitude': 'REAL',
+            'longitude': 'REAL',
+        }
+        self.val_dates = ('dtFraicheur', 'dtCreation')
+        #the long texts of the ads, stored compressed in results_text
+        #and read only when an ad is printed (see get_text)
+        self.cold_fields = (
+            'titre', 
+            'libelle', 
+            'proximite', 
+            'descriptif', 
+            'permaLien',
+        )
+        #the columns of the results table
+        self.hot_fields = tuple([val for val in self.val_xml 
+            if val not in self.cold_fields])
+        self.hot_index = [self.val_xml.index(val) for val in self.hot_fields]
+        self.cold_index = [self.val_xml.index(val) 
+                for val in self.cold_fields]
         #the primary key of the results table
         self.primary_key = 'idAnnonce'
-
-    def _dict_factory(self, cursor, row):
-        """just a small trick to get returns from the
-        searches inside the database as dictionnaries
+        #number of ads inserted by each executemany
+        self.insert_batch = 100
+        #the upgrades of the schema, in order 
+        #(the version of a database is the number of upgrades applied)
+        self.migrations = (
+            self._create_tables,
+            self._create_crawl_state,
+            self._create_indexes,
+            self._type_results,
+            self._create_stats,
+            self._create_retention_indexes,
+            self._split_results_text,
+        )
+        #builds the rows read from the database (see record.py)
+        self._record_factory = RecordFactory()
+        #the stats rollup tables and the value each one groups by
+        self.stats_tables = (
+            ('stats_rooms', 'results.nbPiece'),
+            ('stats_surface', 'CAST(results.surface AS INTEGER)'),
+        )
+
+    def stop(self):
+        """function interrupting the current refresh
+        (the downloads in progress fail at once)
         """
-        d = {}
-        for idx,col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
+        self.stopped.set()
+        self.fetcher.stop()
 
     def close(self):
         """function closing the database cleanly
         """
-        for db in self.dbs.itervalues():
-            db.close()
+        if self.known is not None:
+            with self.write_lock:
+                self._save_known()
+        with self.dbs_lock:
+            for db in self.dbs.itervalues():
+                db.close()
+            self.dbs.clear()
+        self.fetcher.close()
 
     def _getDb(self):
-        """this function returns a database connexion, if the
-        database doesn't exist, it creates it.
+        """this function returns the database connexion of the current
+        thread (each thread has its own), if the database doesn't exist, 
+        it creates it, if it was created by a previous version of the 
+        plugin, it upgrades it.
         no argument.
         """
+        thread = threading.currentThread()
+        db = self.dbs.get(thread)
+        if db is not None:
+            return db
+
         try:
             import sqlite3
         except ImportError:
             raise callbacks.Error, 'You need to have sqlite3 installed to ' \
                                    'use SeLoger.'
-        filename = 'db.seloger'
+        with self.dbs_lock:
+            #the connexions of the threads which ended are closed
+            for dead in [t for t in self.dbs if not t.isAlive()]:
+                self.dbs.pop(dead).close()
+
+            #(only used by its thread, but closed by the one calling close)
+            db = sqlite3.connect(self.filename, timeout = 30,
+                    check_same_thread = False)
+            #only applied to a new database (before the journal mode is
+            #written), the older ones are rebuilt by rebuild_vacuum
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            #with the write-ahead log, the readers don't wait for the
+            #refresh writing the ads
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            if not self.migrated:
+                self._migrate(db, self.filename)
+                self._load_known(db)
+                self.migrated = True
+            self.dbs[thread] = db
+        return db
 
-        if filename in self.dbs:
-            return self.dbs[filename]
-        if os.path.exists(filename):
-            self.dbs[filename] = sqlite3.connect(
-                filename, check_same_thread = False
-                )
+    def _migrate(self, db, filename):
+        """plays the migrations of the schema not already applied,
+        the version of the schema is kept in PRAGMA user_version
+        (the number of migrations applied)
+        arg 1: the database connexion
+        arg 2: the name of the database file
+        """
+        cursor = db.cursor()
+        cursor.row_factory = self._record_factory
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()['user_version']
+        #the databases created before the versioning have the tables
+        #of the first migration but no version
+        if version == 0:
+            cursor.execute("""SELECT name FROM sqlite_master 
+                              WHERE type = 'table' AND name = 'searches'""")
+            if cursor.fetchone() is not None:
+                version = 1
+
+        #each migration is played in its own transaction (with the 
+        #default isolation level, sqlite3 commits before each CREATE)
+        isolation_level = db.isolation_level
+        db.isolation_level = None
+        try:
+            for number in range(version + 1, len(self.migrations) + 1):
+                self.log.info('upgrading database %s to version %s', 
+                        filename, str(number))
+                cursor.execute("BEGIN")
+                try:
+                    self.migrations[number - 1](cursor)
+                    cursor.execute("PRAGMA user_version = %d" % number)
+                except:
+                    cursor.execute("ROLLBACK")
+                    raise
+                cursor.execute("COMMIT")
+        finally:
+            db.isolation_level = isolation_level
 
-            return self.dbs[filename]
-        db = sqlite3.connect(filename, check_same_thread = False)
-        self.dbs[filename] = db
+    def _load_known(self, db):
+        """loads the filter of the stored ads (see known) saved by the 
+        previous run, and adds the rows stored since, it's built from 
+        the database if the file is missing or the filter is full
+        arg 1: the database connexion
+        """
         cursor = db.cursor()
+        cursor.row_factory = self._record_factory
+        try:
+            (known, marks) = BloomFilter.load(self.known_filename)
+            saved = (len(known), marks)
+            for (table, column) in (('results', 'idAnnonce'), 
+                    ('map', 'uniq_id')):
+                cursor.execute("SELECT %s AS id FROM %s WHERE rowid > (?)" 
+                        % (column, table), (marks[table], ))
+                for row in cursor:
+                    known.add(row['id'])
+        except (IOError, ValueError, KeyError, TypeError):
+            known = None
+        if known is None or len(known) > known.capacity:
+            self._build_known(cursor)
+        else:
+            self.known = known
+            self.known_saved = saved
 
+    def _build_known(self, cursor):
+        """builds the filter of the stored ads (see known) from 
+        the database, with room for as many rows again
+        arg 1: the cursor
+        """
+        cursor.row_factory = self._record_factory
+        cursor.execute("""SELECT (SELECT COUNT(*) FROM results) + 
+                                 (SELECT COUNT(*) FROM map) AS number""")
+        number = cursor.fetchone()['number']
+        known = BloomFilter(max(self.known_capacity, 2 * number), 
+                self.known_error)
+        for (table, column) in (('results', 'idAnnonce'), 
+                ('map', 'uniq_id')):
+            cursor.execute("SELECT %s AS id FROM %s" % (column, table))
+            for row in cursor:
+                known.add(row['id'])
+        self.log.info('filter of the stored ads built from %s rows', 
+                str(number))
+        self.known = known
+        self.known_saved = None
+
+    def _save_known(self):
+        """saves the filter of the stored ads (see known) with the last 
+        rowids of results and map (the rows after them are added by 
+        _load_known), unless neither changed since the last save,
+        only one thread at a time must call it
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = self._record_factory
+        marks = {}
+        for table in ('results', 'map'):
+            cursor.execute("SELECT MAX(rowid) AS last FROM %s" % table)
+            marks[table] = cursor.fetchone()['last'] or 0
+        saved = (len(self.known), marks)
+        if saved == self.known_saved:
+            return
+        try:
+            self.known.save(self.known_filename, marks)
+            self.known_saved = saved
+        except (IOError, OSError), e:
+            self.log.warning('failed to save %s: %s', self.known_filename,
+                    str(e))
+
+    def _create_tables(self, cursor):
+        """first version of the schema
+        arg 1: the cursor
+        """
         #initialisation of the searches table 
         #(contains the searches entered by each user) 
         #search_id: the id of the search 
@@ -140,7 +387,7 @@ class SqliteSeLogerDB(object):
         #min_surf: minimum surface of the annonce
         #max_price: maximum rent
         #ad_type: type of the ad (1 -> rent, 2 -> sell)
-        cursor.execute("""CREATE TABLE searches (
+        cursor.execute("""CREATE TABLE IF NOT EXISTS searches (
                           search_id TEXT PRIMARY KEY,
                           owner_id TEXT, 
                           flag_active INTEGER,
@@ -157,7 +404,7 @@ class SqliteSeLogerDB(object):
         #owner_id: the id of an owner
         #flag_shown: a flag set to 0 when the annonce was already 
         #           presented to owner_id, 0 if not
-        cursor.execute("""CREATE TABLE map (
+        cursor.execute("""CREATE TABLE IF NOT EXISTS map (
                           uniq_id TEXT PRIMARY KEY,
                           idAnnonce TEXT,
                           flag_shown INT,
@@ -178,28 +425,336 @@ class SqliteSeLogerDB(object):
                                 + ' TEXT, '
 
         #finally: creation of the table
-        cursor.execute("""CREATE TABLE results (
+        cursor.execute("""CREATE TABLE IF NOT EXISTS results (
                           %s
                           UNIQUE (idAnnonce)ON CONFLICT IGNORE)""" % 
                           table_results 
                       )
 
-        db.commit()
-        self.log.info('database %s created',filename)
-        return db
+    def _create_crawl_state(self, cursor):
+        """creates the crawl_state table
+        arg 1: the cursor
+        """
+        #state of the incremental crawl of each search
+        #url: the url of the first page of the search
+        #high_water: the most recent dtCreation stored for this search
+        #            (seconds since the epoch since the version 4)
+        #signature: identifies the searches which shared this url
+        cursor.execute("""CREATE TABLE IF NOT EXISTS crawl_state (
+                          url TEXT PRIMARY KEY,
+                          high_water TEXT,
+                          signature TEXT)"""
+                      )
+
+    def _create_indexes(self, cursor):
+        """creates the indexes of the usual queries
+        arg 1: the cursor
+        """
+        #the ads not printed yet (get_new)
+        cursor.execute("""CREATE INDEX IF NOT EXISTS map_flag_shown 
+                          ON map (flag_shown)""")
+        #the ads of a user (get_all)
+        cursor.execute("""CREATE INDEX IF NOT EXISTS map_owner_id 
+                          ON map (owner_id, ad_type)""")
+        #the searches to play (do_searches)
+        cursor.execute("""CREATE INDEX IF NOT EXISTS searches_flag_active 
+                          ON searches (flag_active)""")
+        #the searches of a user (get_search)
+        cursor.execute("""CREATE INDEX IF NOT EXISTS searches_owner_id 
+                          ON searches (owner_id)""")
+
+    def _type_results(self, cursor):
+        """gives their type (see val_types) to the numeric columns of
+        results and to the high water marks of crawl_state, the existing
+        rows are converted ('Unknown' values become NULL)
+        arg 1: the cursor
+        """
+        cursor.connection.create_function('seloger_value', 2, 
+                self._typed_value)
+
+        cursor.execute("""CREATE TABLE results_typed (
+                          %s,
+                          UNIQUE (idAnnonce) ON CONFLICT IGNORE)""" %
+                          self._results_columns(self.val_xml)
+                      )
+        cursor.execute("INSERT INTO results_typed SELECT %s FROM results" %
+                ', '.join(["seloger_value('%s', %s)" % (val, val)
+                    for val in self.val_xml]))
+        cursor.execute("DROP TABLE results")
+        cursor.execute("ALTER TABLE results_typed RENAME TO results")
+
+        cursor.execute("""CREATE TABLE crawl_state_typed (
+                          url TEXT PRIMARY KEY,
+                          high_water INTEGER,
+                          signature TEXT)"""
+                      )
+        cursor.execute("""INSERT INTO crawl_state_typed 
+                          SELECT url, seloger_value('dtCreation', high_water),
+                                 signature 
+                          FROM crawl_state""")
+        cursor.execute("DROP TABLE crawl_state")
+        cursor.execute("ALTER TABLE crawl_state_typed RENAME TO crawl_state")
+
+    def _results_columns(self, fields):
+        """returns the definition of the columns of the results table
+        arg 1: the fields (see val_xml)
+        """
+        columns = []
+        for val in fields:
+            if val == self.primary_key:
+                columns.append(val + ' TEXT PRIMARY KEY')
+            else:
+                columns.append(val + ' ' + self.val_types.get(val, 'TEXT'))
+        return ', '.join(columns)
+
+    def _typed_value(self, val, value):
+        """converts a value read from seloger to the type of its column
+        arg 1: the name of the field (see val_xml)
+        arg 2: the value (text), None or 'Unknown' if missing
+        returns the converted value, None if it's missing or invalid
+        """
+        if value is None or value == u'Unknown':
+            return None
+        if val in self.val_dates:
+            return self._to_time(value)
+        column_type = self.val_types.get(val)
+        try:
+            if column_type == 'REAL':
+                return float(value)
+            if column_type == 'INTEGER':
+                return int(float(value))
+        except ValueError:
+            return None
+        return unicode(value)
+
+    def _to_time(self, date):
+        """converts a date of seloger to seconds since the epoch,
+        None if it's not a date
+        arg 1: the date ('YYYY-MM-DDTHH:MM:SS')
+        """
+        if isinstance(date, (int, long)):
+            return date
+        match = SELOGER_DATE.match(date)
+        if match is None:
+            return None
+        return calendar.timegm([int(part or 0) for part in match.groups()])
+
+    def _create_stats(self, cursor):
+        """creates the stats rollup tables and fills them from the 
+        existing ads
+        arg 1: the cursor
+        """
+        #sums of the ads of each owner, by postal code and by number of 
+        #rooms (stats_rooms) or surface range of 1 m2 (stats_surface),
+        #only the ads with a price and a surface are counted
+        #bucket: the number of rooms, or the surface (rounded down)
+        #number: the number of ads
+        #price_sum, surface_sum, price_m2_sum: the sums of the prices,
+        #            the surfaces and the prices per square meter 
+        #min_surface, max_surface: the extreme surfaces
+        for (table, bucket) in self.stats_tables:
+            cursor.execute("""CREATE TABLE IF NOT EXISTS %s (
+                              owner_id TEXT,
+                              ad_type TEXT,
+                              cp TEXT,
+                              bucket INTEGER,
+                              number INTEGER,
+                              price_sum REAL,
+                              surface_sum REAL,
+                              price_m2_sum REAL,
+                              min_surface REAL,
+                              max_surface REAL,
+                              PRIMARY KEY (owner_id, ad_type, cp, bucket))"""
+                              % table
+                          )
+        self._fill_stats(cursor)
+
+    def _stats_query(self, bucket, where):
+        """builds the query summing the ads of each stats group
+        arg 1: the value grouped by (see stats_tables)
+        arg 2: the condition on the map rows
+        """
+        return """SELECT map.owner_id AS owner_id, map.ad_type AS ad_type, 
+                         results.cp AS cp, %s AS bucket, COUNT(*) AS number,
+                         SUM(results.prix) AS price_sum, 
+                         SUM(results.surface) AS surface_sum,
+                         SUM(results.prix / results.surface) AS price_m2_sum,
+                         MIN(results.surface) AS min_surface,
+                         MAX(results.surface) AS max_surface
+                  FROM map JOIN results ON results.idAnnonce = map.idAnnonce
+                  WHERE %s AND results.prix IS NOT NULL 
+                  AND results.surface > 0 AND %s IS NOT NULL
+                  GROUP BY 1, 2, 3, 4""" % (bucket, where, bucket)
+
+    def _fill_stats(self, cursor):
+        """computes the stats rollup tables from all the ads
+        (they must be empty)
+        arg 1: the cursor
+        """
+        for (table, bucket) in self.stats_tables:
+            cursor.execute("INSERT INTO %s %s" % (table, 
+                self._stats_query(bucket, '1')))
+
+    def _add_stats(self, cursor, where, parameters, sign=1):
+        """adds map rows to the stats rollup tables, or removes them
+        (the extreme surfaces are kept when rows are removed)
+        arg 1: the cursor
+        arg 2: the condition on the map rows
+        arg 3: the parameters of the condition
+        arg 4: 1 to add the rows, -1 to remove them
+        """
+        for (table, bucket) in self.stats_tables:
+            cursor.row_factory = self._record_factory
+            cursor.execute(self._stats_query(bucket, where), parameters)
+            for group in cursor.fetchall():
+                key = (group['owner_id'], group['ad_type'], group['cp'], 
+                        group['bucket'])
+                sums = (sign * group['number'], sign * group['price_sum'], 
+                        sign * group['surface_sum'], 
+                        sign * group['price_m2_sum'])
+                cursor.execute("""UPDATE %s SET number = number + (?),
+                                  price_sum = price_sum + (?),
+                                  surface_sum = surface_sum + (?),
+                                  price_m2_sum = price_m2_sum + (?),
+                                  min_surface = MIN(min_surface, (?)),
+                                  max_surface = MAX(max_surface, (?))
+                                  WHERE owner_id = (?) AND ad_type = (?) 
+                                  AND cp IS (?) AND bucket = (?)""" % table,
+                        sums + (group['min_surface'], group['max_surface'])
+                        + key
+                        )
+                if cursor.rowcount == 0 and sign > 0:
+                    cursor.execute(
+                        "INSERT INTO %s VALUES (?,?,?,?,?,?,?,?,?,?)" % table,
+                        key + sums + (group['min_surface'], 
+                            group['max_surface'])
+                        )
+            if sign < 0:
+                cursor.execute("DELETE FROM %s WHERE number <= 0" % table)
+
+    def _create_retention_indexes(self, cursor):
+        """creates the indexes used to prune the database
+        arg 1: the cursor
+        """
+        #the expired ads
+        cursor.execute("""CREATE INDEX IF NOT EXISTS results_dtCreation 
+                          ON results (dtCreation)""")
+        #the owners of an ad
+        cursor.execute("""CREATE INDEX IF NOT EXISTS map_idAnnonce 
+                          ON map (idAnnonce)""")
+
+    def _split_results_text(self, cursor):
+        """moves the long texts of the ads (see cold_fields) from 
+        results to the results_text table, compressed
+        arg 1: the cursor
+        """
+        cursor.connection.create_function('seloger_pack', 
+                len(self.cold_fields), self._pack_text)
+
+        #idAnnonce: the id of the ad
+        #data: the texts of the ad (zlib compressed json list, 
+        #      in the order of cold_fields)
+        cursor.execute("""CREATE TABLE IF NOT EXISTS results_text (
+                          idAnnonce TEXT PRIMARY KEY,
+                          data BLOB,
+                          UNIQUE (idAnnonce) ON CONFLICT IGNORE)"""
+                      )
+        cursor.execute("""INSERT INTO results_text 
+                          SELECT idAnnonce, seloger_pack(%s) 
+                          FROM results""" % ', '.join(self.cold_fields))
+
+        cursor.execute("""CREATE TABLE results_hot (
+                          %s,
+                          UNIQUE (idAnnonce) ON CONFLICT IGNORE)""" %
+                          self._results_columns(self.hot_fields)
+                      )
+        cursor.execute("INSERT INTO results_hot SELECT %s FROM results" %
+                ', '.join(self.hot_fields))
+        cursor.execute("DROP TABLE results")
+        cursor.execute("ALTER TABLE results_hot RENAME TO results")
+        #the index dropped with the table
+        cursor.execute("""CREATE INDEX IF NOT EXISTS results_dtCreation 
+                          ON results (dtCreation)""")
+
+    def _pack_text(self, *values):
+        """compresses the long texts of an ad
+        arg 1..: the values of the cold_fields
+        """
+        return buffer(zlib.compress(json.dumps(values)))
+
+    def _unpack_text(self, data):
+        """returns the dictionnary of the long texts of an ad
+        arg 1: the compressed texts (see _pack_text), None if missing
+        """
+        if data is None:
+            return dict([(val, None) for val in self.cold_fields])
+        return dict(zip(self.cold_fields, 
+            json.loads(zlib.decompress(data))))
+
+    def _insert_results(self, cursor, results):
+        """inserts ads in results and their long texts in results_text
+        (the ads already there are ignored)
+        arg 1: the cursor
+        arg 2: the list of ads (tuples of values in the order of val_xml)
+        """
+        annonce_id_index = self.val_xml.index('idAnnonce')
+        cursor.executemany(
+                "INSERT INTO results VALUES (" + \
+                ','.join(itertools.repeat('?', len(self.hot_fields))) + ")",
+                [[values_list[i] for i in self.hot_index] 
+                    for values_list in results]
+                )
+        cursor.executemany(
+                "INSERT INTO results_text VALUES (?, ?)",
+                [(values_list[annonce_id_index], self._pack_text(
+                    *[values_list[i] for i in self.cold_index]))
+                    for values_list in results]
+                )
+
+    def get_text(self, idAnnonce):
+        """returns the long texts of an ad (see cold_fields)
+        as a dictionnary
+        arg 1: the ad unique ID ('idAnnonce')
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = self._record_factory
+        cursor.execute(
+            """SELECT data FROM results_text WHERE idAnnonce = (?)""",
+            (idAnnonce, )
+            )
+        row = cursor.fetchone()
+        return self._unpack_text(row and row['data'] or None)
 
     def _get_annonce(self, idAnnonce):
         """backend function getting the information of one ad
            arg 1: the ad unique ID ('idAnnonce') 
         """
         db = self._getDb()
-        db.row_factory = self._dict_factory
+        db.row_factory = self._record_factory
         cursor = db.cursor()
         cursor.execute(
             """SELECT * FROM results WHERE idAnnonce = (?)""",
             (idAnnonce, )
             )
-        return cursor.fetchone()
+        annonce = cursor.fetchone()
+        if annonce is not None:
+            annonce = dict(annonce)
+            annonce.update(self.get_text(idAnnonce))
+        return annonce
+
+    def _search_url(self, cp, min_surf, max_price, ad_type, nb_pieces_min):
+        """builds the url of the first page of a search
+        arg 1: the postal code
+        arg 2: the minimal surface
+        arg 3: the maximum rent
+        arg 4: type of the add (1 -> location, 2 -> sell) 
+        arg 5: nb_pieces_min, minimum number of rooms 
+        """
+        nb_pieces_search = ','.join([str(x) for x in range(int(nb_pieces_min), 20)])
+        return 'http://ws.seloger.com/search.xml?cp=' + cp + \
+        '&idqfix=1&idtt=' + ad_type + '&idtypebien=1,2&pxmax=' + max_price + \
+        '&surfacemin=' + min_surf + '&nb_pieces=' + nb_pieces_search
 
     def _search_seloger(self, cp, min_surf, max_price, ad_type, owner_id, nb_pieces_min):
         """entry function for getting the ads on seloger.com
@@ -213,92 +768,438 @@ class SqliteSeLogerDB(object):
         """
         owner_id.lower() 
         #the first url for the search
-        nb_pieces_search = ','.join([str(x) for x in range(int(nb_pieces_min), 20)])
-        url = 'http://ws.seloger.com/search.xml?cp=' + cp + \
-        '&idqfix=1&idtt=' + ad_type + '&idtypebien=1,2&pxmax=' + max_price + \
-        '&surfacemin=' + min_surf + '&nb_pieces=' + nb_pieces_search
+        url = self._search_url(cp, min_surf, max_price, ad_type, nb_pieces_min)
+        subscriber = self._subscriber(owner_id, min_surf, max_price, 
+                nb_pieces_min)
+        self._crawl(self._new_job(url, ad_type, [subscriber]))
+
+    def _subscriber(self, owner_id, min_surf, max_price, nb_pieces_min):
+        """builds the thresholds of one search, used to filter
+        locally the results of a query shared by several searches
+        arg 1: the owner_id of the search
+        arg 2: the minimal surface
+        arg 3: the maximum price
+        arg 4: the minimum number of rooms
+        """
+        return {
+            'owner_id': owner_id,
+            'min_surf': float(min_surf),
+            'max_price': float(max_price),
+            'nb_pieces': float(nb_pieces_min),
+            }
+
+    def _new_job(self, url, ad_type, subscribers):
+        """builds the dictionnary of a distinct query to play
+        url: the url of the first page
+        ad_type: type of the ads (1 -> location, 2 -> sell)
+        subscribers: the list of subscribers (see _subscriber)
+        crawl: the crawl state (see _crawl_state) if the pagination 
+               stops on known ads, None to get every page
+        new_rows: the number of map rows inserted
+        failed: True if a page could not be downloaded or parsed
+        """
+        return {'url': url, 'ad_type': ad_type, 'subscribers': subscribers,
+                'crawl': None, 'new_rows': 0, 'failed': False}
 
+    def _crawl(self, job):
+        """plays one search for a group of searches sharing it
+        arg 1: the job (see _new_job), its new_rows and failed 
+               fields are updated
+        """
+        if job['crawl'] is None and self.known_ads_cutoff > 0:
+            job['crawl'] = self._crawl_state(job['url'], job['subscribers'])
+        url = job['url']
         #we search all the pages 
         #(the current page gives the next if it exists)
-        while url is not None:
-                url = self._get(url, ad_type, owner_id)
-
-    def _get(self, url, ad_type, owner_id):
+        while url is not None and not self.stopped.isSet():
+                page = self._get(url, job['ad_type'], job['subscribers'], 
+                        job['crawl'], job['url'])
+                job['new_rows'] += page['new_rows']
+                job['failed'] = job['failed'] or page['failed']
+                if page['stop']:
+                    break
+                url = page['next']
+
+    def _get(self, url, ad_type, subscribers, crawl=None, search=None):
         """
         function getting the xml pages  and putting
         the results inside the database
         arg 1: the url giving the nice xml
-        arg 2: the owner_id of the search
+        arg 2: type of the ads (1 -> location, 2 -> sell)
+        arg 3: the list of subscribers (see _subscriber) of the search
+        arg 4: the crawl state (see _crawl_state) or None
+        arg 5: the url of the first page of the search (url by default)
+        returns the page (see _new_page)
         """
-        owner_id.lower() 
+        page = self._new_page(url, crawl, search)
+        #the page is downloaded and parsed before the database is locked
+        #(as in _refresh_concurrent)
+        ads = list(self._fetch_page(page, subscribers))
+        self._store_page(page, ads, ad_type, subscribers)
+        return page
+
+    def _new_page(self, url, crawl=None, search=None):
+        """builds the dictionnary following a page through the refresh
+        url: the url of the page
+        search: the url of the first page of the search (url by default)
+        next: the url of the next page (set by _fetch_page)
+        failed: True if the page could not be entirely read
+        unchanged: True if the page was already stored as it is
+        seen: (idAnnonce, dtCreation) of every ad of the page, in order
+        new: idAnnonce of the ads mapped for the first time to one of
+             the subscribers of the search
+        new_rows: the number of map rows inserted
+        crawl: the crawl state of the search (see _crawl_state) or None
+        stop: True if the following pages must not be downloaded
+        """
+        if search is None:
+            search = url
+        return {'url': url, 'search': search, 'next': None,
+                'failed': False, 'unchanged': False, 'seen': [], 'new': set(),
+                'new_rows': 0, 'crawl': crawl, 'stop': False}
+
+    def _crawl_state(self, url, subscribers):
+        """loads the state of the incremental crawl of a search: 
+        the most recent creation date stored for it (high water mark)
+        and the number of consecutive known ads seen so far.
+        if the subscribers of the search changed since the last crawl,
+        there is no cutoff (the new ones must get every ad).
+        arg 1: the url of the first page of the search
+        arg 2: the list of subscribers (see _subscriber) of the search
+        """
+        signature = md5.new(repr(self._signature(subscribers))).hexdigest()
         db = self._getDb()
+        db.row_factory = self._record_factory
         cursor = db.cursor()
+        cursor.execute(
+            "SELECT high_water, signature FROM crawl_state WHERE url = (?)",
+            (url, )
+            )
+        row = cursor.fetchone()
+        crawl = {'url': url, 'signature': signature, 'known': 0,
+                'high_water': None, 'newest': None, 'enabled': False}
+        if row is not None:
+            crawl['newest'] = row['high_water']
+            if row['signature'] == signature:
+                crawl['high_water'] = row['high_water']
+                crawl['enabled'] = True
+        return crawl
+
+    def _update_crawl(self, page):
+        """after a page was stored, counts the consecutive known ads
+        (already mapped to its owners, ignored, or not more recent than 
+        the high water mark) and sets page['stop'] when there are enough 
+        of them, then saves the new high water mark (the caller commits)
+        arg 1: the page (see _new_page)
+        """
+        crawl = page['crawl']
+        if page['unchanged']:
+            #every ad of this page is already known
+            page['stop'] = crawl['enabled']
+            return
+
+        for (annonce_id, date) in page['seen']:
+            if annonce_id in page['new'] and (crawl['high_water'] is None
+                    or date > crawl['high_water']):
+                crawl['known'] = 0
+            else:
+                crawl['known'] += 1
+            if annonce_id in page['new'] and (crawl['newest'] is None 
+                    or date > crawl['newest']):
+                crawl['newest'] = date
+        if crawl['enabled'] and crawl['known'] >= self.known_ads_cutoff:
+            page['stop'] = True
+
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.execute("INSERT OR REPLACE INTO crawl_state VALUES (?,?,?)",
+                (crawl['url'], crawl['newest'], crawl['signature']))
+
+    def _signature(self, subscribers):
+        """small function identifying a group of subscribers"""
+        return tuple(sorted([(sub['owner_id'], sub['min_surf'], 
+            sub['max_price'], sub['nb_pieces']) for sub in subscribers]))
+
+    def _page_stored(self, page, subscribers):
+        """remembers that a page was stored for a group of subscribers,
+        if it doesn't change, it won't be parsed again for this group
+        arg 1: the page (see _new_page)
+        arg 2: the list of subscribers (see _subscriber) of the search
+        """
+        self.stored_pages[page['url']] = (page['next'],
+                self._signature(subscribers), page['search'])
+
+    def _forget_pages(self, searches):
+        """forgets the stored pages of the searches not played anymore
+        arg 1: the set of the urls of the first pages of the searches
+        """
+        for (url, stored) in self.stored_pages.items():
+            if stored[2] not in searches:
+                del self.stored_pages[url]
+
+    def _fetch_page(self, page, subscribers):
+        """
+        generator downloading and parsing one xml page, it yields the ads
+        as they are parsed, and doesn't touch the database 
+        (safe to call from any thread)
+        arg 1: the page (see _new_page), 'next' is set in it once every 
+               ad was yielded, and 'failed' is set to True if the page 
+               was only partially read
+        arg 2: the list of subscribers (see _subscriber) of the search
+        yields the ads to insert (tuples of values)
+        """
+        url = page['url']
 
         #we try to load the xml page
         try:
-            tree = etree.parse(url)
-        except:
+            response = self.fetcher.get(url, stream=True)
+        except FetchError, e:
             #if we have some troubles loading the page
-            self.log.warning('could not download %s',url)
+            self.log.warning('could not download %s', str(e))
+            page['failed'] = True
+            return
+
+        #if the page didn't change since we stored it for the same
+        #subscribers, there is nothing new to parse or insert
+        if response.unchanged and url in self.stored_pages:
+            (next_url, signature, search) = self.stored_pages[url]
+            if signature == self._signature(subscribers):
+                page['next'] = next_url
+                page['unchanged'] = True
+                return
+        #the page is parsed again until it's stored (see _page_stored),
+        #even if it doesn't change after a failed store
+        self.stored_pages.pop(url, None)
+
+        cutoff = calendar.timegm((datetime.date.today() - 
+            datetime.timedelta(days=self.max_age_days - 1)).timetuple())
+        try:
+            for annonce in self._parse_page(response.open(), page):
+                values_list = self._extract_ad(annonce, cutoff, page)
+                if values_list is not None:
+                    yield values_list
+        except (etree.XMLSyntaxError, socket.error, 
+                httplib.HTTPException), e:
+            self.log.warning('could not parse %s: %s', url, str(e))
+            page['failed'] = True
+            page['next'] = None
+        finally:
+            response.close()
+
+    def _parse_page(self, source, page):
+        """
+        generator parsing incrementally a page, it yields the 
+        'annonce' elements one by one and clears them once used,
+        the url of the next page is put in page['next']
+        arg 1: file like object reading the xml
+        arg 2: the page (see _fetch_page)
+        """
+        for event, element in etree.iterparse(source, events=('end',),
+                tag=('annonce', 'pageSuivante')):
+            parent = element.getparent()
+            if element.tag == 'pageSuivante':
+                #it's only the next page if it's under the root 
+                if parent is not None and parent.tag == 'recherche' \
+                        and parent.getparent() is None:
+                    page['next'] = element.text
+            elif parent is not None and parent.tag == 'annonces':
+                yield element
+            #we free the memory used by the elements already processed
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+
+    def _extract_ad(self, annonce, cutoff, page):
+        """gets the values of an ad from its xml element
+        arg 1: the 'annonce' element
+        arg 2: the oldest creation date accepted (seconds since the epoch)
+        arg 3: the page (see _new_page), the ad is added to page['seen']
+        returns the tuple of values (see _typed_value), 
+        or None if the ad must be ignored
+        """
+        #one walk on the children of the ad
+        fields = {}
+        for child in annonce:
+            fields[child.tag] = child.text
+        date = fields.get('dtCreation')
+        if date is not None:
+            date = self._to_time(date)
+        page['seen'].append((fields.get('idAnnonce'), date))
+
+        # ignore ads that are more than 30 days old
+        if date is None or date < cutoff:
             return None
-        
-        #we get the info from the xml
-        root = tree.getroot()
-        annonces = root.find('annonces')
 
-        if annonces is None:
+        # ignore Viager
+        if VIAGER_DESCRIPTION.search(fields.get('descriptif') or '') \
+                or VIAGER_LINK.search(fields.get('permaLien') or ''):
             return None
 
-        for annonce in annonces:
-            values_list=[]
-            for val in self.val_xml:
-                #if the value exists we put it in the db
-                #if it doesn't we put "Unknown"
-                if annonce.find(val) is None or annonce.find(val).text is None:
-                    values_list.append(u'Unknown')
+        #if the value exists we put it in the db
+        #if it doesn't we put NULL
+        values_list = []
+        for val in self.val_xml:
+            value = fields.get(val)
+            if value is not None:
+                if val == 'dtCreation':
+                    value = date
+                elif val in self.val_types:
+                    value = self._typed_value(val, value)
                 else:
-                    values_list.append(unicode(annonce.find(val).text))
-
-            # ignore ads that are more than 30 days old
-            d = datetime.datetime.strptime(annonce.find('dtCreation').text, '%Y-%m-%dT%H:%M:%S')
-            n = datetime.datetime.now()
-            delta = n.date() - d.date()
-
-            # inserting the ad information inside the table
-            # ignore Viager
-            if not re.match(r'.*[Vv]iager.*', annonce.find('descriptif').text) \
-		and not re.match(r'.*/viagers/.*', annonce.find('permaLien').text) \
-		and delta.days < 30:
-                cursor.execute(
-                        "INSERT INTO results VALUES (" + \
-                        ','.join(itertools.repeat('?', self.val_xml_count)) + ")",
-                        tuple(values_list)
-                        )
+                    value = unicode(value)
+            values_list.append(value)
+        return tuple(values_list)
+
+    def _match_search(self, values_list, subscriber):
+        """checks an ad against the thresholds of a search,
+        unknown values are not filtered out
+        arg 1: the values of the ad (as returned by _extract_ad)
+        arg 2: the subscriber (see _subscriber)
+        """
+        for (field, threshold, sign) in (
+                ('prix', 'max_price', -1),
+                ('surface', 'min_surf', 1),
+                ('nbPiece', 'nb_pieces', 1),
+                ):
+            value = values_list[self.val_xml.index(field)]
+            if value is None:
+                continue
+            if sign * (value - subscriber[threshold]) < 0:
+                return False
+        return True
+
+    def _store_page(self, page, ads, ad_type, subscribers):
+        """
+        function putting the ads of one page inside the database, 
+        in one transaction, only one thread at a time must call it.
+        a page is stored completely or not at all: if the download or 
+        the parsing fails partway (page['failed'] is set by _fetch_page), 
+        or if an insert fails, the ads of the page already inserted are 
+        rolled back, they will be inserted again at the next refresh.
+        arg 1: the page (see _new_page)
+        arg 2: iterable of ads (as returned by _extract_ad)
+        arg 3: type of the ads (1 -> location, 2 -> sell)
+        arg 4: the list of subscribers (see _subscriber) of the search
+        """
+        db = self._getDb()
+        with self.write_lock:
+            try:
+                self._store_ads(ads, ad_type, subscribers, page)
+                if page['failed']:
+                    db.rollback()
+                    page['new_rows'] = 0
+                    return
+                if page['crawl'] is not None:
+                    self._update_crawl(page)
+            except:
+                db.rollback()
+                raise
+            db.commit()
+        self._page_stored(page, subscribers)
+
+    def _store_ads(self, ads, ad_type, subscribers, page):
+        """
+        function inserting ads inside the database by batches,
+        it doesn't commit (see _store_page)
+        arg 1: iterable of ads (as returned by _extract_ad)
+        arg 2: type of the ads (1 -> location, 2 -> sell)
+        arg 3: the list of subscribers (see _subscriber) of the search
+        arg 4: the page (see _new_page)
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        annonce_id_index = self.val_xml.index('idAnnonce')
+
+        results = []
+        mapping = []
+        for values_list in ads:
+            #the searches of the group this ad really matches
+            owners = [sub['owner_id'] for sub in subscribers 
+                    if self._match_search(values_list, sub)]
+            if not owners:
+                continue
 
-                annonce_id = annonce.find('idAnnonce').text
+            results.append(values_list)
+            annonce_id = values_list[annonce_id_index]
 
+            for owner_id in set(owners):
                 #calcul of the uniq id for the mapping between 
                 #the searcher and the ad
                 uniq_id = md5.new(owner_id + annonce_id).hexdigest()
-
-                #inserting the new ad inside map
-                cursor.execute("INSERT INTO map VALUES (?,?,?,?,?)",\
-                        (uniq_id, annonce_id, '1', ad_type, owner_id))
-                db.commit()
-
-        #if there is another page, we return it, we return None otherwise
-        if tree.xpath('//recherche/pageSuivante'):
-            return  tree.xpath('//recherche/pageSuivante')[0].text
-        else:
-            return None
-
-    def _get_date(self, ad):
+                mapping.append((uniq_id, annonce_id, '1', ad_type, owner_id))
+
+            if len(results) >= self.insert_batch:
+                self._insert_batch(cursor, results, mapping, page)
+                results = []
+                mapping = []
+
+        self._insert_batch(cursor, results, mapping, page)
+
+    def _insert_batch(self, cursor, results, mapping, page):
+        """inserts a batch of ads and of their mapping to the owners
+        arg 1: the cursor
+        arg 2: the list of ads (tuples of values)
+        arg 3: the list of map rows
+        arg 4: the page (see _new_page), the ads of the new map rows
+               are added to page['new'] for the crawl cutoff
         """
-        function getting the creation date of an ad
-        arg 1: ad
+        if not results:
+            return
+        #only the ads and map rows not already stored are inserted
+        annonce_id_index = self.val_xml.index('idAnnonce')
+        ids = [values_list[annonce_id_index] for values_list in results]
+        stored = self._stored(cursor, 'results', 'idAnnonce', ids)
+        results = [values_list for values_list in results
+                if values_list[annonce_id_index] not in stored]
+        stored = self._stored(cursor, 'map', 'uniq_id', 
+                [row[0] for row in mapping])
+        mapping = [row for row in mapping if row[0] not in stored]
+        #an ad stored by another search is still new for these owners
+        if page['crawl'] is not None:
+            page['new'].update([row[1] for row in mapping])
+
+        # inserting the ads information inside the tables
+        self._insert_results(cursor, results)
+        for values_list in results:
+            self.known.add(values_list[annonce_id_index])
+        if not mapping:
+            return
+        #inserting the new ads inside map
+        #(the new rows are after the current last rowid)
+        cursor.row_factory = self._record_factory
+        cursor.execute("SELECT MAX(rowid) AS last FROM map")
+        last_rowid = cursor.fetchone()['last'] or 0
+        cursor.executemany("INSERT INTO map VALUES (?,?,?,?,?)", mapping)
+        for row in mapping:
+            self.known.add(row[0])
+        new_rows = cursor.rowcount
+        page['new_rows'] += new_rows
+        #and adding them to the stats
+        if new_rows > 0:
+            self._add_stats(cursor, 'map.rowid > (?)', (last_rowid, ))
+
+
+    def _stored(self, cursor, table, column, ids):
+        """returns the set of the ids already stored in a table,
+        only the ids found in known are looked for in the database
+        arg 1: the cursor
+        arg 2: the table (results or map)
+        arg 3: the column of the ids (idAnnonce or uniq_id)
+        arg 4: the list of ids
         """
-        return ad['dtCreation']
-
+        ids = [i for i in ids if i in self.known]
+        stored = set()
+        cursor.row_factory = self._record_factory
+        #(by 500 to stay under the limit of parameters of sqlite)
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            cursor.execute(
+                "SELECT %s AS id FROM %s WHERE %s IN (" % (column, table, 
+                    column) + ','.join(itertools.repeat('?', len(batch))) +
+                ")", batch
+                )
+            stored.update([row['id'] for row in cursor])
+        return stored
 
     def add_search(self, owner_id, cp, min_surf, max_price, ad_type, nb_pieces_min):
         """this function adds a search inside the database
@@ -332,26 +1233,187 @@ class SqliteSeLogerDB(object):
         """
         self.log.info('begin refreshing database')
         db = self._getDb()
-        db.row_factory = self._dict_factory
+        db.row_factory = self._record_factory
         cursor = db.cursor()
         #we select all the active searches
         cursor.execute("SELECT * FROM searches WHERE flag_active = 1")
-
-        #for each searches we query seloger.com
-        for row in cursor.fetchall():
-            self._search_seloger(
-                row['cp'],row['min_surf'],row['max_price'],row['ad_type'],row['owner_id'],row['nb_pieces']
-                )
+        searches = cursor.fetchall()
+
+        #identical searches of different users are played only once
+        all_jobs = self._plan_searches(searches)
+        planned = set([job['url'] for job in all_jobs])
+        self.poller.forget(planned)
+        self._forget_pages(planned)
+
+        #only the searches which are due are played
+        now = time.time()
+        jobs = [job for job in all_jobs if self.poller.is_due(job['url'], now)]
+        self.log.info('%s searches, %s distinct queries, %s due', 
+                len(searches), len(all_jobs), len(jobs))
+        for job in jobs:
+            if self.known_ads_cutoff > 0:
+                job['crawl'] = self._crawl_state(job['url'], 
+                        job['subscribers'])
+
+        if self.refresh_threads > 1 and len(jobs) > 1:
+            self._refresh_concurrent(jobs)
+        else:
+            #for each distinct search we query seloger.com
+            for job in jobs:
+                if self.stopped.isSet():
+                    break
+                self._crawl(job)
+
+        #the next poll of each search depends on the new ads it gave,
+        #the searches which failed are played again after a backoff
+        if not self.stopped.isSet():
+            now = time.time()
+            for job in jobs:
+                if job['failed']:
+                    self.log.warning('refresh of %s failed', job['url'])
+                    self.poller.failed(job['url'], now)
+                else:
+                    self.poller.record(job['url'], job['new_rows'], now)
+        stats = self.fetcher.stats()
+        self.log.info('fetcher: %s requests, %s errors, %s ms on average, '
+                '%s ms at most', str(stats['requests']), str(stats['errors']),
+                str(int(stats['elapsed'] * 1000 / max(1, stats['requests']))),
+                str(int(stats['max_elapsed'] * 1000)))
+        if self.fetcher.limiter is not None:
+            stats = self.fetcher.limiter.stats()
+            self.log.info('rate limiter: %s requests, %s delayed '
+                    '(%s seconds), at most %s waiting, %s failures, '
+                    '%s requests per second',
+                    str(stats['acquired']), str(stats['delayed']),
+                    str(int(stats['wait_time'])), str(stats['max_waiting']),
+                    str(stats['failures']), str(stats['rate']))
         self.log.info('end refreshing database')
 
+    def next_refresh(self):
+        """returns the time (in seconds) until a search is due,
+        None if no search is scheduled
+        """
+        return self.poller.next_due(time.time())
+
+    def _plan_searches(self, searches):
+        """groups the searches sharing a postal code and a type of ad
+        into one query wide enough for all of them (highest price, 
+        lowest surface and number of rooms), the thresholds of each 
+        search are then applied locally when storing the ads.
+        if coalesce_searches is off, only identical searches are grouped.
+        arg 1: the list of searches (rows of the searches table)
+        returns a list of jobs (see _new_job)
+        """
+        jobs = []
+        jobs_by_key = {}
+        for row in searches:
+            if self.coalesce_searches:
+                key = (row['cp'], row['ad_type'])
+            else:
+                key = self._search_url(row['cp'], row['min_surf'], 
+                        row['max_price'], row['ad_type'], row['nb_pieces'])
+            if key not in jobs_by_key:
+                job = self._new_job(None, row['ad_type'], [])
+                job['cp'] = row['cp']
+                jobs_by_key[key] = job
+                jobs.append(job)
+            jobs_by_key[key]['subscribers'].append(self._subscriber(
+                row['owner_id'], row['min_surf'], row['max_price'], 
+                row['nb_pieces']))
+
+        #the widest query of each group
+        for job in jobs:
+            subscribers = job['subscribers']
+            job['url'] = self._search_url(job['cp'],
+                    str(int(min([sub['min_surf'] for sub in subscribers]))),
+                    str(int(max([sub['max_price'] for sub in subscribers]))),
+                    job['ad_type'],
+                    str(int(min([sub['nb_pieces'] for sub in subscribers]))))
+        return jobs
+
+    def _refresh_concurrent(self, jobs_list):
+        """plays the searches with a pool of worker threads,
+        the workers download and parse the pages, the calling thread
+        is the only one writing inside the database
+        arg 1: the list of jobs (as returned by _plan_searches)
+        """
+        jobs = Queue.Queue()
+        for job in jobs_list:
+            jobs.put(job)
+
+        #bounded, so the workers can't get too far ahead of the writer
+        pages = Queue.Queue(maxsize = 4 * self.refresh_threads)
+
+        workers = []
+        for i in range(min(self.refresh_threads, len(jobs_list))):
+            t = threading.Thread(None, self._refresh_worker, None, 
+                    (jobs, pages))
+            t.setDaemon(True)
+            t.start()
+            workers.append(t)
+
+        #each worker puts None in the queue when it's done
+        running = len(workers)
+        while running > 0:
+            page = pages.get()
+            if page is None:
+                running -= 1
+                continue
+            ads, page, job = page
+            try:
+                self._store_page(page, ads, job['ad_type'], job['subscribers'])
+                job['new_rows'] += page['new_rows']
+                job['failed'] = job['failed'] or page['failed']
+            except Exception:
+                #the workers must not be left waiting for the writer
+                self.log.exception('could not store %s', page['url'])
+                job['failed'] = True
+            #the worker may be waiting for the page to be stored
+            page['stored'].set()
+
+        for t in workers:
+            t.join()
+
+    def _refresh_worker(self, jobs, pages):
+        """worker thread of _refresh_concurrent
+        arg 1: the queue of jobs to play
+        arg 2: the queue of parsed pages handed to the writer
+        """
+        try:
+            while True:
+                try:
+                    job = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                url = job['url']
+                while url is not None and not self.stopped.isSet():
+                    page = self._new_page(url, job['crawl'], job['url'])
+                    page['stored'] = threading.Event()
+                    ads = list(self._fetch_page(page, job['subscribers']))
+                    pages.put((ads, page, job))
+                    if job['crawl'] is not None:
+                        #the writer decides if we go on with the next page
+                        page['stored'].wait()
+                        if page['stop']:
+                            break
+                    url = page['next']
+        except Exception:
+            self.log.exception('refresh worker failed')
+        finally:
+            pages.put(None)
+
     def disable_search(self, search_id, owner_id):
         """ this function disable a search
         arg 1: the unique id of the search
         agr 2: the owner_id of the search
         """
         self.log.info('disabling search %s',search_id)
+        #the ads of the owner are pruned if it was their last search
+        with self.write_lock:
+            if self.pruned_owners is not None:
+                self.pruned_owners.add(owner_id)
         db = self._getDb()
-        db.row_factory = self._dict_factory
+        db.row_factory = self._record_factory
         cursor = db.cursor()
         #we delete the given search of the given user
         cursor.execute(
@@ -368,7 +1430,7 @@ class SqliteSeLogerDB(object):
         self.log.info('printing search list of %s', owner_id)
         owner_id.lower() 
         db = self._getDb()
-        db.row_factory = self._dict_factory
+        db.row_factory = self._record_factory
         cursor = db.cursor()
         #we get all the searches of the given user
         cursor.execute(
@@ -385,60 +1447,65 @@ class SqliteSeLogerDB(object):
         no argument
         """
         db = self._getDb()
-        db.row_factory = self._dict_factory
+        db.row_factory = self._record_factory
         cursor = db.cursor()
-        #we get all the new ads
-        cursor.execute("SELECT * FROM map WHERE flag_shown = 1")
-
-        return_annonces=[]
-        for row in cursor.fetchall():
-            uniq = row['uniq_id']
-            #we mark the ad as "read"
+        #we get all the new ads with their owner, sorted by date
+        cursor.execute("""SELECT results.*, map.owner_id AS owner_id, 
+                                 map.rowid AS map_rowid
+                          FROM map JOIN results 
+                          ON results.idAnnonce = map.idAnnonce
+                          WHERE map.flag_shown = 1
+                          ORDER BY results.dtCreation""")
+        return_annonces = cursor.fetchall()
+
+        #we mark them as "read", the ads inserted since the select
+        #(after the last rowid) stay new
+        last = None
+        for result in return_annonces:
+            last = max(last, result['map_rowid'])
+        if last is not None:
             cursor.execute(
-                """UPDATE map SET flag_shown = 0 WHERE uniq_id = (?)""",
-                (uniq, )
+                """UPDATE map SET flag_shown = 0 
+                   WHERE flag_shown = 1 AND rowid <= (?)""",
+                (last, )
                 )
-            #we get the infos of the ad
-            result = self._get_annonce(row['idAnnonce'])
-            #we ad in the result the name of the owner
-            result['owner_id'] = row['owner_id']
-            return_annonces.append(result)
+            db.commit()
 
-        db.commit()
-
-        #we sort the ads by date
-        return_annonces.sort(key=self._get_date)
         #we get the number of new ads
         number_of_new_ads = str(len(return_annonces))
         self.log.info('printing %s new ads', number_of_new_ads)
         #we return the ads
         return return_annonces
 
-    def get_all(self, owner_id, pc='all', ad_type='1'):
-        """ this function returns all the ads of a given user and postal code
+    def iter_all(self, owner_id, pc='all', ad_type='1'):
+        """ generator yielding all the ads of a given user and postal code,
+        the rows are read from the database as they are consumed
         arg1: the owner id
-        arg2: the postal code
+        arg2: the postal code ('all' for every postal code)
+        arg3: type of the ads (1 -> location, 2 -> sell)
         """
         db = self._getDb()
-        db.row_factory = self._dict_factory
         cursor = db.cursor()
-        #we get all the ads of a given user
-        cursor.execute("SELECT * FROM map WHERE owner_id = (?) AND ad_type = (?)",
-                (owner_id, ad_type)
-                )
+        cursor.row_factory = self._record_factory
+        query = """SELECT results.*, map.owner_id AS owner_id 
+                   FROM map JOIN results 
+                   ON results.idAnnonce = map.idAnnonce
+                   WHERE map.owner_id = (?) AND map.ad_type = (?)"""
+        parameters = (owner_id, ad_type)
+        #we filter on the postal code unless all the ads are queried
+        if pc != 'all':
+            query += " AND results.cp = (?)"
+            parameters += (pc, )
+        cursor.execute(query, parameters)
+        for row in cursor:
+            yield row
 
-        return_annonces=[]
-        for row in cursor.fetchall():
-            uniq = row['uniq_id']
-
-            #we get the infos of the ad
-            result = self._get_annonce(row['idAnnonce'])
-            #we ad in the result the name of the owner
-            result['owner_id'] = row['owner_id']
-            #we ad it only if we query all the ads 
-            #or it matches the postal code
-            if pc == 'all' or result['cp'] == pc:
-                return_annonces.append(result)
+    def get_all(self, owner_id, pc='all', ad_type='1'):
+        """ this function returns all the ads of a given user and postal code
+        arg1: the owner id
+        arg2: the postal code
+        """
+        return_annonces = list(self.iter_all(owner_id, pc, ad_type))
 
         #we get the number of ads
         number_of_ads = str(len(return_annonces))
@@ -446,6 +1513,266 @@ class SqliteSeLogerDB(object):
         #we return the ads
         return return_annonces
 
+    def rebuild_stats(self):
+        """ this function computes again the stats rollup tables
+        from all the ads
+        no argument
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        with self.write_lock:
+            try:
+                for (table, bucket) in self.stats_tables:
+                    cursor.execute("DELETE FROM %s" % table)
+                self._fill_stats(cursor)
+            except:
+                db.rollback()
+                raise
+            db.commit()
+        self.log.info('stats rebuilt')
+
+    def rebuild_vacuum(self):
+        """ this function rebuilds a database created by an older version
+        of the plugin to allow the incremental vacuum done by prune (the
+        writes wait until the whole database is copied)
+        no argument
+        returns False if it was already allowed
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = self._record_factory
+        cursor.execute("PRAGMA auto_vacuum")
+        #2: incremental
+        if cursor.fetchone()['auto_vacuum'] == 2:
+            return False
+        self.log.info('rebuilding the database for incremental vacuum')
+        with self.write_lock:
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            cursor.execute("VACUUM")
+        self.log.info('database rebuilt')
+        return True
+
+    def idle(self, deadline):
+        """ this function maintains the database between two refreshes:
+        it saves the filter of the stored ads (see known) if it changed,
+        built again if it's full, and prunes the database (see prune)
+        arg1: the time (seconds since the epoch) to return before
+        """
+        db = self._getDb()
+        with self.write_lock:
+            #the deleted rows and the rows added stay in the filter
+            if len(self.known) > self.known.capacity:
+                self._build_known(db.cursor())
+            self._save_known()
+        self.prune(deadline)
+
+    def prune(self, deadline):
+        """ this function removes from the database, by small 
+        transactions until deadline: the ads older than retention_days 
+        (with their map rows), then the map rows of the users without 
+        active search (and their ads no one else has) among the ones
+        who disabled a search (see pruned_owners), then gives back
+        the free pages to the file system (incremental vacuum)
+        arg1: the time (seconds since the epoch) to return before
+        """
+        if self.retention_days <= 0:
+            return
+        days = max(self.retention_days, self.max_age_days + 1)
+        cutoff = calendar.timegm((datetime.date.today() - 
+            datetime.timedelta(days=days)).timetuple())
+        db = self._getDb()
+        cursor = db.cursor()
+        removed = {'ads': 0, 'map': 0}
+
+        for (step, argument) in ((self._prune_expired, cutoff), 
+                (self._prune_owners, None)):
+            while time.time() < deadline and not self.stopped.isSet():
+                with self.write_lock:
+                    try:
+                        number = step(cursor, argument, removed)
+                    except:
+                        db.rollback()
+                        raise
+                    db.commit()
+                if number == 0:
+                    break
+        if removed['ads'] > 0 or removed['map'] > 0:
+            self.log.info('pruning: %s ads and %s map rows removed', 
+                    str(removed['ads']), str(removed['map']))
+        self._vacuum(cursor, deadline)
+
+    def _prune_expired(self, cursor, cutoff, removed):
+        """removes one batch of expired ads and their map rows
+        arg1: the cursor
+        arg2: the oldest creation date kept (seconds since the epoch)
+        arg3: the counters of removed rows
+        returns the number of ads removed
+        """
+        cursor.row_factory = self._record_factory
+        cursor.execute("""SELECT idAnnonce FROM results 
+                          WHERE dtCreation < (?) OR dtCreation IS NULL 
+                          LIMIT (?)""", (cutoff, self.prune_batch))
+        ids = [row['idAnnonce'] for row in cursor.fetchall()]
+        if not ids:
+            return 0
+        cursor.execute("SELECT rowid FROM map WHERE idAnnonce IN (" + \
+                ','.join(itertools.repeat('?', len(ids))) + ")", ids)
+        self._delete_map_rows(cursor, 
+                [row['rowid'] for row in cursor.fetchall()], removed)
+        cursor.execute("DELETE FROM results WHERE idAnnonce IN (" + \
+                ','.join(itertools.repeat('?', len(ids))) + ")", ids)
+        removed['ads'] += cursor.rowcount
+        cursor.execute("DELETE FROM results_text WHERE idAnnonce IN (" + \
+                ','.join(itertools.repeat('?', len(ids))) + ")", ids)
+        return len(ids)
+
+    def _prune_owners(self, cursor, unused, removed):
+        """removes one batch of the map rows of the users who have no
+        active search left (a disabled search is deleted), and the ads
+        no one else has, only the users of pruned_owners are checked
+        and they are removed from it once done
+        arg1: the cursor
+        arg2: unused
+        arg3: the counters of removed rows
+        returns the number of map rows removed
+        """
+        owners = self.pruned_owners
+        if owners is not None and not owners:
+            return 0
+        owners_filter = ''
+        parameters = ()
+        if owners is not None:
+            #(the number of parameters of a query is limited)
+            owners = list(owners)[:self.prune_batch]
+            owners_filter = "owner_id IN (" + \
+                    ','.join(itertools.repeat('?', len(owners))) + ") AND"
+            parameters = tuple(owners)
+        cursor.row_factory = self._record_factory
+        cursor.execute("""SELECT rowid, idAnnonce FROM map 
+                          WHERE %s owner_id NOT IN (
+                              SELECT owner_id FROM searches 
+                              WHERE flag_active = 1)
+                          LIMIT (?)""" % owners_filter,
+                          parameters + (self.prune_batch, ))
+        rows = cursor.fetchall()
+        if not rows:
+            if owners is None:
+                self.pruned_owners = set()
+            else:
+                self.pruned_owners.difference_update(owners)
+            return 0
+        self._delete_map_rows(cursor, [row['rowid'] for row in rows], 
+                removed)
+        ids = list(set([row['idAnnonce'] for row in rows]))
+        cursor.execute("DELETE FROM results WHERE idAnnonce IN (" + \
+                ','.join(itertools.repeat('?', len(ids))) + ") " + \
+                """AND NOT EXISTS (SELECT 1 FROM map 
+                   WHERE map.idAnnonce = results.idAnnonce)""", ids)
+        removed['ads'] += cursor.rowcount
+        cursor.execute("DELETE FROM results_text WHERE idAnnonce IN (" + \
+                ','.join(itertools.repeat('?', len(ids))) + ") " + \
+                """AND NOT EXISTS (SELECT 1 FROM results 
+                   WHERE results.idAnnonce = results_text.idAnnonce)""", 
+                ids)
+        return len(rows)
+
+    def _delete_map_rows(self, cursor, rowids, removed):
+        """deletes map rows and removes them from the stats
+        arg1: the cursor
+        arg2: the rowids of the map rows
+        arg3: the counters of removed rows
+        """
+        for i in range(0, len(rowids), self.prune_batch):
+            batch = rowids[i:i + self.prune_batch]
+            where = "map.rowid IN (" + \
+                    ','.join(itertools.repeat('?', len(batch))) + ")"
+            self._add_stats(cursor, where, batch, -1)
+            cursor.execute("DELETE FROM map WHERE " + where, batch)
+            removed['map'] += cursor.rowcount
+
+    def _vacuum(self, cursor, deadline):
+        """gives back the free pages of the database until deadline,
+        only if the database allows the incremental vacuum (see 
+        rebuild_vacuum)
+        arg1: the cursor
+        arg2: the time (seconds since the epoch) to return before
+        """
+        cursor.row_factory = self._record_factory
+        cursor.execute("PRAGMA auto_vacuum")
+        #2: incremental
+        if cursor.fetchone()['auto_vacuum'] != 2:
+            return
+        while time.time() < deadline and not self.stopped.isSet():
+            cursor.execute("PRAGMA freelist_count")
+            if cursor.fetchone()['freelist_count'] == 0:
+                break
+            with self.write_lock:
+                #the pages are freed while the rows are read
+                cursor.execute("PRAGMA incremental_vacuum(%d)" % 
+                        self.vacuum_pages)
+                cursor.fetchall()
+
+    def get_stats(self, owner_id, pc='all', ad_type='1', number_of_steps=7,
+            max_step=5):
+        """ this function computes the stats of the ads of a given user 
+        and postal code, grouped by number of rooms and by surface range.
+        for each group: 'number' (of ads), average 'surface', 'price' and
+        'price_m2' (price per square meter).
+        the surface ranges are 'step' square meters wide, the step is
+        (max surface - min surface) / number_of_steps, between 1 and 
+        max_step.
+        the ads without price, surface or number of rooms are not counted
+        arg1: the owner id
+        arg2: the postal code ('all' for every postal code)
+        arg3: type of the ads (1 -> location, 2 -> sell)
+        returns a dictionnary: {'rooms': [groups], 'surface': [groups],
+        'step': step}, the groups are sorted by 'bucket' (the number of 
+        rooms, or the surface divided by the step)
+        """
+        db = self._getDb()
+        cursor = db.cursor()
+        cursor.row_factory = self._record_factory
+        parameters = (owner_id, ad_type)
+        cp_filter = ''
+        #we filter on the postal code unless all the ads are queried
+        if pc != 'all':
+            cp_filter = 'AND cp = (?)'
+            parameters += (pc, )
+        #the groups are read from the rollup tables, the surface ranges
+        #are made of the 1 m2 ranges of stats_surface
+        cursor.execute("""
+            WITH surfaces AS (
+                SELECT * FROM stats_surface
+                WHERE owner_id = (?) AND ad_type = (?) %s),
+            bounds AS (
+                SELECT MIN(MAX(1, CAST((MAX(max_surface) - MIN(min_surface))
+                                  / (?) AS INTEGER)), (?)) AS step 
+                FROM surfaces)
+            SELECT 'rooms' AS kind, bucket, SUM(number) AS number,
+                   SUM(surface_sum) / SUM(number) AS surface, 
+                   SUM(price_sum) / SUM(number) AS price, 
+                   SUM(price_m2_sum) / SUM(number) AS price_m2, 
+                   NULL AS step
+            FROM stats_rooms 
+            WHERE owner_id = (?) AND ad_type = (?) %s
+            GROUP BY bucket
+            UNION ALL
+            SELECT 'surface', bucket / step, SUM(number), 
+                   SUM(surface_sum) / SUM(number), 
+                   SUM(price_sum) / SUM(number), 
+                   SUM(price_m2_sum) / SUM(number), step
+            FROM surfaces, bounds GROUP BY 2
+            ORDER BY 1, 2""" % (cp_filter, cp_filter), 
+            parameters + (number_of_steps, max_step) + parameters
+            )
+
+        stats = {'rooms': [], 'surface': [], 'step': None}
+        for row in cursor:
+            stats[row['kind']].append(row)
+            if row['step'] is not None:
+                stats['step'] = row['step']
+        return stats
+
 
 class SeLoger(callbacks.Plugin):
     """This plugin search and alerts you in query if 
@@ -458,10 +1785,45 @@ class SeLoger(callbacks.Plugin):
     def __init__(self,irc):
         self.__parent = super(SeLoger, self)
         self.__parent.__init__(irc)
-        self.backend = SqliteSeLogerDB(self.log)
-        self.gettingLockLock = threading.Lock()
-        self.locks = {}
+        transport = HttpTransport(
+                connect_timeout=self.registryValue('connectTimeout'),
+                read_timeout=self.registryValue('readTimeout'))
+        cache = None
+        if self.registryValue('cacheTTL') > 0:
+            cache = ResponseCache(
+                    conf.supybot.directories.data.dirize('SeLoger/cache'),
+                    ttl=self.registryValue('cacheTTL'),
+                    max_size=self.registryValue('cacheSize') * 1024 * 1024)
+        limiter = TokenBucket(self.registryValue('requestsPerSecond'),
+                self.registryValue('requestsBurst'))
+        fetcher = Fetcher(transport,
+                retries=self.registryValue('fetchRetries'), cache=cache,
+                limiter=limiter)
+        self.backend = SqliteSeLogerDB(self.log,
+                refresh_threads=self.registryValue('refreshThreads'),
+                coalesce_searches=self.registryValue('coalesceSearches'),
+                fetcher=fetcher,
+                known_ads_cutoff=self.registryValue('knownAdsCutoff'),
+                poller=AdaptivePoller(self.registryValue('refreshInterval'),
+                    self.registryValue('maxRefreshInterval')),
+                retention_days=self.registryValue('retentionDays'))
         self.graph = Pyasciigraph()
+        #the irc used to print the new ads (set by __call__)
+        self.irc = None
+        #the database is maintained between the refreshes
+        self.scheduler = RefreshScheduler(self._print,
+                self.registryValue('refreshInterval'), self.log,
+                idle=self.backend.idle, finish=self.backend.close)
+        self.scheduler.start()
+
+    def die(self):
+        """stops the refresh thread, which closes the database"""
+        self.backend.stop()
+        self.scheduler.stop(30)
+        if self.scheduler.isAlive():
+            self.log.warning('the refresh thread is still running, '
+                    'it will close the database when it ends')
+        self.__parent.die()
 
     ### the external methods
 
@@ -540,8 +1902,7 @@ class SeLoger(callbacks.Plugin):
         Specify 'all' (no filter), or a specific postal code
         """
         user = irc.msg.nick 
-        self._gen_stat_rooms(user, irc, pc, '1')
-        self._gen_stat_surface(user, irc, pc, '1')
+        self._gen_stats(user, irc, pc, '1')
         msg='Done slstatrent'
         irc.reply(msg,to=user,private=True)
 
@@ -553,13 +1914,38 @@ class SeLoger(callbacks.Plugin):
         Specify 'all' (no filter), or a specific postal code
         """
         user = irc.msg.nick 
-        self._gen_stat_rooms(user, irc, pc, '2')
-        self._gen_stat_surface(user, irc, pc, '2')
+        self._gen_stats(user, irc, pc, '2')
         msg='Done slstatbuy'
         irc.reply(msg,to=user,private=True)
 
     slstatbuy = wrap(slstatbuy, ['text'])
 
+    def slrebuildstats(self, irc, msg, args):
+        """usage: slrebuildstats
+        computes again the stats of every user from their ads
+        (owner only)
+        """
+        user = irc.msg.nick 
+        self.backend.rebuild_stats()
+        msg='Done slrebuildstats'
+        irc.reply(msg,to=user,private=True)
+
+    slrebuildstats = wrap(slrebuildstats, ['owner'])
+
+    def slvacuum(self, irc, msg, args):
+        """usage: slvacuum
+        rebuilds a database created by an older version of the plugin,
+        to give back the space freed by the deletions (owner only)
+        """
+        user = irc.msg.nick 
+        if self.backend.rebuild_vacuum():
+            msg='Done slvacuum'
+        else:
+            msg='Nothing to do, the database is already up to date'
+        irc.reply(msg,to=user,private=True)
+
+    slvacuum = wrap(slvacuum, ['owner'])
+
     def colors(self, irc, msg, args):
         for color in range(16):
             msg = ircutils.mircColor(str(color), color)
@@ -588,68 +1974,39 @@ class SeLoger(callbacks.Plugin):
             irc.reply(msg,to=user,private=True)
 
 
-    def _gen_stat_rooms(self, user, irc, pc, ad_type):
-        """internal function generating stats about the number of rooms
+    def _gen_stats(self, user, irc, pc, ad_type):
+        """internal function generating all the stats of a user
         """
-        #we get all the ads of the user (with a filter on the postal code)
-        ads = self.backend.get_all(user, pc, ad_type)
+        #one query for all the stats (with a filter on the postal code)
+        stats = self.backend.get_stats(user, pc, ad_type)
+        self._gen_stat_rooms(user, irc, stats)
+        self._gen_stat_surface(user, irc, stats)
 
+    def _gen_stat_rooms(self, user, irc, stats):
+        """internal function generating stats about the number of rooms
+        """
         #if we have nothing to make stats on
-        if len(ads) == 0:
+        if len(stats['rooms']) == 0:
             msg = 'no stats about number of rooms available'
             irc.reply(msg,to=user,private=True)
             return
 
-        number_ads_by_room = {}
-        surface_by_room = {}
-        price_by_room = {}
-        surface_by_room = {}
-
         list_surface = []
         list_price = []
         list_number = []
 
-        for ad in ads:
-            rooms = ad['nbPiece']
-            #we increment 'n (rooms)' 
-            if rooms in number_ads_by_room:
-                number_ads_by_room[rooms] += 1
-            else:
-                number_ads_by_room[rooms] = 1
-
-            #we add the price to the corresponding field
-            if rooms in price_by_room:
-                price_by_room[rooms] += float(ad['prix'])
-            else:
-                price_by_room[rooms] = float(ad['prix'])
-
-            #we add the surface to the corresponding field
-            if rooms in surface_by_room:
-                surface_by_room[rooms] += float(ad['surface'])
-            else:
-                surface_by_room[rooms] = float(ad['surface'])
-    
         #we generate the list of tuples
-        for rooms in sorted(surface_by_room, key=int):
+        for group in stats['rooms']:
+            label = str(group['bucket']) + ' room(s)'
 
             #the list for number of ads by number of rooms
-            list_number.append(( rooms  + ' room(s)',
-                number_ads_by_room[rooms]))
+            list_number.append((label, group['number']))
 
-            #calcul of the avrage surface for this number of rooms
-            surface_by_room[rooms] = surface_by_room[rooms] \
-                    / number_ads_by_room[rooms]
+            #the avrage surface for this number of rooms
+            list_surface.append((label, int(group['surface'])))
 
-            list_surface.append(( rooms  + ' room(s)', 
-                int(surface_by_room[rooms]))) 
-
-
-            #calcul of the avrage price for this number of rooms
-            price_by_room[rooms] = price_by_room[rooms] \
-                / number_ads_by_room[rooms] 
-
-            list_price.append(( rooms  + ' room(s)', 
-                int(price_by_room[rooms])))
+            #the avrage price for this number of rooms
+            list_price.append((label, int(group['price'])))
 
         #we print all that
         graph_number = self.graph.graph(u'number of ads by room', list_number)
@@ -661,91 +2018,36 @@ class SeLoger(callbacks.Plugin):
         graph_price = self.graph.graph(u'price by room', list_price)
         self._print_stats(user, irc, graph_price)
 
-    def _get_step(self, ads, id_row, number_of_steps):
-        """internal function generating a step for numerical range
-        """
-        mini = float(ads[0][id_row])
-        maxi = float(ads[0][id_row])
-
-        for ad in ads:
-            value = float(ad[id_row]) 
-            if value > maxi:
-                maxi = value
-            if value < mini:
-                mini = value
-        return max(1, int((maxi - mini) / number_of_steps))
-
-    def _gen_stat_surface(self, user, irc, pc, ad_type):
+    def _gen_stat_surface(self, user, irc, stats):
         """internal function generating stats about the surface
         """
-        #we get all the ads of the user (with a filter on the postal code)
-        ads = self.backend.get_all(user, pc, ad_type)
         #if we have nothing to make stats on
-        if len(ads) == 0:
+        if len(stats['surface']) == 0:
             msg = 'no stats about surface available'
             irc.reply(msg,to=user,private=True)
             return
 
-        number_ads_by_range = {}
-        rent_by_range = {}
-        price_by_range = {}
-
-
         list_rent = []
         list_price = []
         list_number = []
 
-        number_of_steps = 7
-        #we calcul the step of the range (max step is 5)
-        step = min(self._get_step(ads, 'surface', number_of_steps), 5)
+        step = stats['step']
 
-        for ad in ads:
-            surface_range = str(int(float(ad['surface']) / step))
-
-            #we count the number of ads by range
-            if surface_range in number_ads_by_range:
-                number_ads_by_range[surface_range] += 1
-            else:
-                number_ads_by_range[surface_range] = 1
-
-            #we add the rent to the corresponding range
-            if surface_range in rent_by_range:
-                rent_by_range[surface_range] += float(ad['prix'])
-            else:
-                rent_by_range[surface_range] = float(ad['prix'])
-    
-            #we add the rent per square meter to the corresponding range
-            if surface_range in price_by_range:
-                price_by_range[surface_range] += float(ad['prix']) \
-                        / float(ad['surface'])
-            else:
-                price_by_range[surface_range] = float(ad['prix']) \
-                        / float(ad['surface'])
- 
         #we generate the list of tuples to print
-        for surface_range in sorted(number_ads_by_range, key=int):
+        for group in stats['surface']:
             #calcul of the label
-            label = str( int(surface_range) * step) + \
+            label = str(group['bucket'] * step) + \
                     ' to ' +\
-                    str((int(surface_range) + 1) * step)
+                    str((group['bucket'] + 1) * step)
 
             #number of ads by range
-            list_number.append(( label,
-                number_ads_by_range[surface_range]))
-
-            #calcul of mid rent by range
-            mid_rent = int(rent_by_range[surface_range] \
-                    / number_ads_by_range[surface_range])
+            list_number.append((label, group['number']))
 
-            list_rent.append(( label,
-                mid_rent))
+            #mid rent by range
+            list_rent.append((label, int(group['price'])))
 
-            #calcul of mid rent per square meter by range
-            mid_price = int(price_by_range[surface_range] \
-                    / number_ads_by_range[surface_range])
-
-            list_price.append(( label,
-                mid_price))
+            #mid rent per square meter by range
+            list_price.append((label, int(group['price_m2'])))
 
         #we print all these stats
         graph_number = self.graph.graph(u'number of ads by surface range', list_number)
@@ -756,15 +2058,13 @@ class SeLoger(callbacks.Plugin):
 
         graph_price = self.graph.graph(u'price per square meter by surface range', list_price)
         self._print_stats(user, irc, graph_price)
- 
- 
+
     def __call__(self, irc, msg):
         """black supybot magic... at least for me
         """
         self.__parent.__call__(irc, msg)
-        irc = callbacks.SimpleProxy(irc, msg)
-        t = threading.Thread(None,self._print, None, (irc,))
-        t.start()
+        #the refresh thread prints the new ads through the last irc seen
+        self.irc = callbacks.SimpleProxy(irc, msg)
 
     def _update_db(self):
         """direct call to do_search from the backend class
@@ -772,47 +2072,44 @@ class SeLoger(callbacks.Plugin):
         """
         self.backend.do_searches()
 
-    def _acquireLock(self, url, blocking=True):
-        """Lock handler for the threads
-        """
-        try:
-            self.gettingLockLock.acquire()
-            try:
-                lock = self.locks[url]
-            except KeyError:
-                lock = threading.RLock()
-                self.locks[url] = lock
-            return lock.acquire(blocking=blocking)
-        finally:
-            self.gettingLockLock.release()
-
-    def _releaseLock(self, url):
-        """Lock handler for the threads
-        """
-        self.locks[url].release()
-
-    def _print(self,irc):
+    def _print(self):
         """This function updates the database 
-        and prints any new results to each user
+        and prints any new results to each user,
+        it's run by the scheduler, and returns the time to wait
+        until a search is due
         """
-        if self._acquireLock('print', blocking=False):
-            self._update_db()
+        self._update_db()
+        irc = self.irc
+        #until the bot got a message, the new ads wait in the database
+        if irc is not None:
             ads = self.backend.get_new()
             total = len(ads)
             counter = 1
             for ad in ads:
                 self._print_ad(ad, irc, counter, total)
                 counter += 1
-            #we search every 5 minutes
-            time.sleep(300)
-            self._releaseLock('print')
+        return self.backend.next_refresh()
 
     def _reformat_date(self, date):
         """small function reformatting the date from SeLoger
+        (seconds since the epoch)
         """
-        d = datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%S')
+        if date is None:
+            return 'Unknown'
+        d = datetime.datetime.utcfromtimestamp(date)
         return  d.strftime('%d/%m/%Y %H:%M')
 
+    def _format(self, value):
+        """small function formatting a value of an ad for printing
+        """
+        if value is None:
+            return u'Unknown'
+        if isinstance(value, float):
+            if value.is_integer():
+                return unicode(int(value))
+            return unicode(repr(value))
+        return unicode(value)
+
     def _print_ad(self,ad,irc, counter, total):
         """this function prints one ad
         """
@@ -824,10 +2121,12 @@ class SeLoger(callbacks.Plugin):
         irc.reply(msg,to=user,private=True)
 
         #printing the pric, number of rooms and surface
-        price = ircutils.mircColor('Prix: ' + ad['prix'] + ad['prixUnite'],8)
-        rooms  = ircutils.mircColor('Pieces: ' + ad['nbPiece'],4) 
+        price = ircutils.mircColor('Prix: ' + self._format(ad['prix']) + 
+                self._format(ad['prixUnite']),8)
+        rooms  = ircutils.mircColor('Pieces: ' + self._format(ad['nbPiece']),4) 
         surface =  ircutils.mircColor(
-                        'Surface: ' + ad['surface'] + ad['surfaceUnite'],
+                        'Surface: ' + self._format(ad['surface']) + 
+                        self._format(ad['surfaceUnite']),
                         13
                         )
 
@@ -835,8 +2134,8 @@ class SeLoger(callbacks.Plugin):
         irc.reply(msg,to=user,private=True)
 
         #printing the city, the postal code and date of the ad
-        city = ircutils.mircColor('Ville: ' + ad['ville'], 11)  
-        cp = ircutils.mircColor('Code postal: ' + ad['cp'], 12) 
+        city = ircutils.mircColor('Ville: ' + self._format(ad['ville']), 11)  
+        cp = ircutils.mircColor('Code postal: ' + self._format(ad['cp']), 12) 
         date = ircutils.mircColor(
                    'Date ajout: ' + self._reformat_date(ad['dtCreation']), 
                    11
@@ -849,24 +2148,28 @@ class SeLoger(callbacks.Plugin):
         #printing a googlemaps url to see where it is (data not accurate)
         msg = ircutils.mircColor(
                     'Localisation: https://maps.google.com/maps?q=' \
-                            + ad['latitude'] + '+' + ad['longitude'], 
+                            + self._format(ad['latitude']) + '+' \
+                            + self._format(ad['longitude']), 
                     3
                     )
         irc.reply(msg,to=user,private=True)
 
+        #the long texts are read from the database only now
+        text = self.backend.get_text(ad['idAnnonce'])
+
         #printing "Proximite" info
-        msg = ircutils.mircColor('Proximite: ' + ad['proximite'],2)
+        msg = ircutils.mircColor('Proximite: ' + self._format(text['proximite']),2)
         irc.reply(msg,to=user,private=True)
 
         #print the description
-        msg = u'Description: ' + ad['descriptif']
+        msg = u'Description: ' + self._format(text['descriptif'])
 
         #\n creates some mess when we print them, so we remove them.
         msg = re.sub(r'\n', r' ', msg)
         irc.reply(msg,to=user,private=True)
 
         #printing the permanent link of the ad
-        msg = ircutils.mircColor('Lien: ' + ad['permaLien'],9)
+        msg = ircutils.mircColor('Lien: ' + self._format(text['permaLien']),9)
         irc.reply(msg,to=user,private=True)
 
         #one more time, an empty line for lisibility
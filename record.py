@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+class Record(tuple):
+    """a row read from the database: a tuple whose values are also
+    read by column name like in a dictionnary (record['prix']),
+    the columns are shared by all the records of a query
+    """
+    __slots__ = ()
+    #the column names (set by record_type)
+    fields = ()
+    #column name -> index of the value
+    index_of = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return tuple.__getitem__(self, self.index_of[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        """value of a column, default if there is no such column"""
+        if key in self.index_of:
+            return tuple.__getitem__(self, self.index_of[key])
+        return default
+
+    def keys(self):
+        return list(self.fields)
+
+    def items(self):
+        return zip(self.fields, self)
+
+    def __contains__(self, key):
+        return key in self.index_of
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+#column names -> Record subclass
+record_types = {}
+
+def record_type(fields):
+    """returns the Record subclass of a list of columns
+    arg1: the tuple of the column names
+    """
+    cls = record_types.get(fields)
+    if cls is None:
+        cls = type('Record', (Record, ), {
+            '__slots__': (),
+            'fields': fields,
+            'index_of': dict([(name, i) for (i, name) in enumerate(fields)]),
+            })
+        record_types[fields] = cls
+    return cls
+
+class RecordFactory(object):
+    """row factory of sqlite3 building Records, the columns of a query
+    are resolved with its first row only
+    """
+
+    def __init__(self):
+        #(description of the last query, its Record subclass)
+        self.last = (None, None)
+
+    def __call__(self, cursor, row):
+        #the description is the same object for all the rows of a query
+        last = self.last
+        if last[0] is not cursor.description:
+            last = (cursor.description, record_type(
+                tuple([column[0] for column in cursor.description])))
+            self.last = last
+        return last[1](row)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import heapq
+import time
+
+class RefreshScheduler(threading.Thread):
+    """long lived thread running the refresh cycles on a timer,
+    started with the plugin and stopped when it dies
+    """
+
+    def __init__(self, cycle, interval, log, idle=None, finish=None):
+        """constructor of RefreshScheduler
+        arg1: the function running one cycle, it can return the time
+              (in seconds) to wait before the next one
+        arg2: the maximum time (in seconds) between the end of a cycle 
+              and the beginning of the next one
+        arg3: the logger
+        arg4: the function run between two cycles, with the time the 
+              next cycle begins as argument (it must return before)
+        arg5: the function run by the thread when it ends
+        """
+        threading.Thread.__init__(self, name='SeLoger refresh')
+        self.setDaemon(True)
+        self.cycle = cycle
+        self.interval = interval
+        self.log = log
+        self.idle = idle
+        self.finish = finish
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            self._loop()
+        finally:
+            if self.finish is not None:
+                try:
+                    self.finish()
+                except Exception:
+                    self.log.exception('end of the refresh thread failed')
+
+    def _loop(self):
+        while not self.stopped.isSet():
+            delay = None
+            try:
+                delay = self.cycle()
+            except Exception:
+                self.log.exception('refresh cycle failed')
+            if delay is None:
+                delay = self.interval
+            next_cycle = time.time() + max(1, min(delay, self.interval))
+            if self.idle is not None and not self.stopped.isSet():
+                try:
+                    self.idle(next_cycle)
+                except Exception:
+                    self.log.exception('idle task failed')
+            self.stopped.wait(max(1, next_cycle - time.time()))
+
+    def stop(self, timeout=None):
+        """stops the thread, waiting for the current cycle to end
+        arg1: maximum time (in seconds) to wait for the thread
+        """
+        self.stopped.set()
+        if self.isAlive() and threading.currentThread() is not self:
+            self.join(timeout)
+
+class AdaptivePoller(object):
+    """decides when each search must be played again: 
+    it follows the rate at which each search brings new ads, and polls 
+    it often enough to get about 'target' new ads per poll, but never
+    more often than min_interval nor less often than max_interval
+    """
+
+    def __init__(self, min_interval=0, max_interval=0, target=0.25,
+            smoothing=0.3):
+        """constructor of AdaptivePoller
+        arg1: minimum time (in seconds) between two polls of a search
+        arg2: maximum time (in seconds) between two polls of a search
+        arg3: the number of new ads expected for each poll
+        arg4: weight of the last poll in the rate of a search
+        """
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.target = target
+        self.smoothing = smoothing
+        #heap of (time of the next poll, search)
+        self.queue = []
+        #search -> time of the next poll
+        self.next_poll = {}
+        #search -> time of the last poll
+        self.last_poll = {}
+        #search -> new ads per second
+        self.rates = {}
+        #search -> delay (in seconds) before playing it again after
+        #a failed poll, doubled at each consecutive failure
+        self.backoffs = {}
+        self.lock = threading.Lock()
+
+    def is_due(self, key, now):
+        """returns True if the search must be played now
+        (a search never played is always due)
+        arg1: the search
+        arg2: the current time
+        """
+        with self.lock:
+            return key not in self.next_poll or self.next_poll[key] <= now
+
+    def _interval(self, key):
+        rate = self.rates.get(key)
+        if rate is None:
+            #we don't know the search yet
+            return self.min_interval
+        if rate <= 0:
+            return self.max_interval
+        return min(self.max_interval, 
+                max(self.min_interval, self.target / rate))
+
+    def record(self, key, new_ads, now):
+        """records a poll of a search, and schedules the next one
+        arg1: the search
+        arg2: the number of new ads the poll brought
+        arg3: the time of the poll
+        """
+        with self.lock:
+            last = self.last_poll.get(key)
+            if last is not None and now > last:
+                sample = new_ads / float(now - last)
+                rate = self.rates.get(key)
+                if rate is None:
+                    self.rates[key] = sample
+                else:
+                    self.rates[key] = self.smoothing * sample \
+                            + (1 - self.smoothing) * rate
+            self.last_poll[key] = now
+            self.backoffs.pop(key, None)
+            self._schedule(key, now + self._interval(key))
+
+    def failed(self, key, now):
+        """records a failed poll of a search, it's played again after 
+        min_interval (at least 1 second), doubled at each consecutive
+        failure up to max_interval
+        arg1: the search
+        arg2: the time of the poll
+        """
+        with self.lock:
+            backoff = self.backoffs.get(key)
+            if backoff is None:
+                backoff = max(1, self.min_interval)
+            else:
+                backoff = min(max(1, self.max_interval), backoff * 2)
+            self.backoffs[key] = backoff
+            self._schedule(key, now + backoff)
+
+    def _schedule(self, key, next_poll):
+        """sets the time of the next poll, the lock must be held"""
+        self.next_poll[key] = next_poll
+        heapq.heappush(self.queue, (next_poll, key))
+
+    def forget(self, keys):
+        """forgets the searches which are not in keys anymore
+        arg1: the searches still active
+        """
+        with self.lock:
+            for key in self.next_poll.keys():
+                if key not in keys:
+                    del self.next_poll[key]
+                    self.last_poll.pop(key, None)
+                    self.rates.pop(key, None)
+                    self.backoffs.pop(key, None)
+
+    def next_due(self, now):
+        """returns the time (in seconds) until the next poll,
+        None if no search is scheduled
+        arg1: the current time
+        """
+        with self.lock:
+            #entries of forgotten or rescheduled searches are dropped
+            while self.queue and \
+                    self.next_poll.get(self.queue[0][1]) != self.queue[0][0]:
+                heapq.heappop(self.queue)
+            if not self.queue:
+                return None
+            return max(0, self.queue[0][0] - now)
@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 ###
 # Copyright (c) 2013, Pierre-Francois Carpentier
 # All rights reserved.
@@ -30,8 +31,963 @@
 
 from supybot.test import *
 
+import os
+import sys
+import time
+import socket
+import threading
+import shutil
+import sqlite3
+import StringIO
+import tempfile
+from lxml import etree
+
+#(after the import of supybot.test, which has its own plugin module)
+import plugin
+from fetcher import Fetcher, HttpTransport, Response, TokenBucket
+from fetcher import FetchError, ResponseCache
+from scheduler import AdaptivePoller, RefreshScheduler
+from record import RecordFactory, record_type
+from bloom import BloomFilter
+
+BENCH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench')
+sys.path.insert(0, BENCH)
+from server import ReplayServer
+from generate import generate
+
 class SeLogerTestCase(PluginTestCase):
     plugins = ('SeLoger',)
 
+    def setUp(self):
+        #the refresh thread starts with the plugin
+        interval = conf.supybot.plugins.SeLoger.refreshInterval
+        self.interval = interval()
+        interval.setValue(1)
+        PluginTestCase.setUp(self)
+
+    def tearDown(self):
+        PluginTestCase.tearDown(self)
+        conf.supybot.plugins.SeLoger.refreshInterval.setValue(self.interval)
+
+    def testRefreshThread(self):
+        cb = self.irc.getCallback('SeLoger')
+        cycles = threading.Event()
+        do_searches = cb.backend.do_searches
+        cb.backend.do_searches = lambda: cycles.set() or do_searches()
+        #the refreshes run on their own, without any irc message
+        cycles.wait(5)
+        self.failUnless(cycles.isSet())
+        self.assertEqual(self.irc.takeMsg(), None)
+        start = time.time()
+        cb.die()
+        self.failUnless(time.time() - start < 5)
+        self.failIf(cb.scheduler.isAlive())
+
+class BackendTestCase(SupyTestCase):
+    """base of the tests of the backend, each test has its own
+    database in a temporary directory"""
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp(prefix='seloger-test-')
+        self.filename = os.path.join(self.directory, 'db.seloger')
+        self.backends = []
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.close()
+        shutil.rmtree(self.directory)
+        SupyTestCase.tearDown(self)
+
+    def backend(self, **kwargs):
+        backend = plugin.SqliteSeLogerDB(log, filename=self.filename,
+                **kwargs)
+        self.backends.append(backend)
+        return backend
+
+    def ad(self, backend, **fields):
+        """values of an ad (see _extract_ad), None for the fields not
+        given"""
+        return tuple([fields.get(val) for val in backend.val_xml])
+
+    def summary(self, stats):
+        """the groups of get_stats, rounded (the rollup tables are
+        updated by additions and subtractions)"""
+        return [(kind, group['bucket'], group['number'],
+            round(group['price'], 6), round(group['price_m2'], 6))
+            for kind in ('rooms', 'surface') for group in stats[kind]]
+
+class MigrationTestCase(BackendTestCase):
+
+    def baseline(self):
+        """creates a database like the first version of the plugin:
+        the tables of _create_tables, every value stored as text
+        ('Unknown' if missing) and no version"""
+        backend = self.backend()
+        backend.migrations = backend.migrations[:1]
+        db = backend._getDb()
+        db.execute("PRAGMA user_version = 0")
+        for (annonce_id, values) in (
+                (u'1', {'dtCreation': u'2014-03-14T18:40:00',
+                    'prix': u'1474', 'nbPiece': u'2', 'surface': u'46.68',
+                    'descriptif': u'joli 2 pièces',
+                    'permaLien': u'http://a'}),
+                (u'2', {'dtCreation': u'2014-03-13T08:00:00',
+                    'prix': u'980.5', 'nbPiece': u'1', 'surface': u'20'}),
+                (u'3', {'dtCreation': u'2014-03-12', 'prix': u'1200'})):
+            values['idAnnonce'] = annonce_id
+            values['cp'] = u'75011'
+            db.execute("INSERT INTO results VALUES (%s)" %
+                    ','.join(['?'] * len(backend.val_xml)),
+                    [values.get(val, u'Unknown') for val in backend.val_xml])
+            db.execute("INSERT INTO map VALUES (?, ?, 1, '1', 'alice')",
+                    ('alice' + annonce_id, annonce_id))
+        db.execute("""INSERT INTO searches
+                      VALUES ('s', 'alice', 1, '75011', '10', '2000', '1',
+                              '1')""")
+        db.commit()
+        backend.close()
+        self.backends.remove(backend)
+
+    def testBaselineUpgrade(self):
+        self.baseline()
+        backend = self.backend()
+        db = backend._getDb()
+        self.assertEqual(db.execute("PRAGMA user_version").fetchone()[0],
+                len(backend.migrations))
+
+        #the values are typed
+        ad = backend._get_annonce(u'1')
+        self.assertEqual(ad['prix'], 1474.0)
+        self.assertEqual(ad['nbPiece'], 2)
+        self.assertEqual(ad['surface'], 46.68)
+        self.assertEqual(ad['dtCreation'], 1394822400)
+        self.assertEqual(ad['latitude'], None)
+        self.assertEqual(ad['titre'], None)
+        self.assertEqual(backend._get_annonce(u'3')['dtCreation'],
+                1394582400)
+        self.assertEqual(backend._get_annonce(u'3')['surface'], None)
+
+        #the long texts are moved to results_text
+        columns = [row['name'] for row in
+                db.execute("PRAGMA table_info(results)")]
+        self.failIf('descriptif' in columns)
+        self.assertEqual(ad['descriptif'], u'joli 2 pièces')
+        self.assertEqual(ad['permaLien'], u'http://a')
+
+        #the stats are computed from the existing ads,
+        #the third one has no surface
+        stats = backend.get_stats('alice')
+        self.assertEqual([(group['bucket'], group['number'], group['price'])
+            for group in stats['rooms']], [(1, 1, 980.5), (2, 1, 1474.0)])
+        self.assertEqual(sum([group['number'] for group in stats['surface']]),
+                2)
+
+        #the ads and the searches are still there
+        self.assertEqual(len(backend.get_all('alice')), 3)
+        self.assertEqual(len(backend.get_search('alice')), 1)
+        self.assertEqual(len(backend.get_new()), 3)
+
+    def testHighWater(self):
+        #a database of the third version, before the typed columns
+        backend = self.backend()
+        backend.migrations = backend.migrations[:3]
+        db = backend._getDb()
+        db.execute("INSERT INTO crawl_state VALUES ('http://a', "
+                "'2014-03-14T18:40:00', 'x')")
+        db.commit()
+        backend.close()
+        self.backends.remove(backend)
+
+        backend = self.backend()
+        crawl = backend._crawl_state('http://a', [])
+        self.assertEqual(crawl['newest'], 1394822400)
+
+    def testUpToDate(self):
+        backend = self.backend()
+        db = backend._getDb()
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        #a new database allows the incremental vacuum
+        self.assertEqual(db.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        self.assertEqual(backend.rebuild_vacuum(), False)
+        backend.close()
+        self.backends.remove(backend)
+        backend = self.backend()
+        db = backend._getDb()
+        self.assertEqual(db.execute("PRAGMA user_version").fetchone()[0],
+                version)
+
+class SearchTestCase(BackendTestCase):
+
+    def search(self, owner_id, cp, min_surf, max_price, ad_type,
+            nb_pieces):
+        return {'owner_id': owner_id, 'cp': cp, 'min_surf': min_surf,
+                'max_price': max_price, 'ad_type': ad_type,
+                'nb_pieces': nb_pieces}
+
+    def testPlanSearches(self):
+        backend = self.backend()
+        searches = [
+            self.search('alice', '75011', '10', '1000', '1', '2'),
+            self.search('bob', '75011', '20', '1500', '1', '1'),
+            self.search('carol', '75011', '20', '300000', '2', '3'),
+            self.search('dave', '75012', '10', '1000', '1', '2'),
+            self.search('eve', '75011', '10', '1000', '1', '2'),
+            ]
+        jobs = backend._plan_searches(searches)
+        self.assertEqual([(job['cp'], job['ad_type'],
+            [sub['owner_id'] for sub in job['subscribers']])
+            for job in jobs], [
+                ('75011', '1', ['alice', 'bob', 'eve']),
+                ('75011', '2', ['carol']),
+                ('75012', '1', ['dave'])])
+        #the widest query of the group
+        self.assertEqual(jobs[0]['url'],
+                backend._search_url('75011', '10', '1500', '1', '1'))
+
+        #only the identical searches share a query
+        backend.coalesce_searches = False
+        jobs = backend._plan_searches(searches)
+        self.assertEqual([[sub['owner_id'] for sub in job['subscribers']]
+            for job in jobs], [['alice', 'eve'], ['bob'], ['carol'],
+                ['dave']])
+        self.assertEqual(jobs[1]['url'],
+                backend._search_url('75011', '20', '1500', '1', '1'))
+
+    def testMatchSearch(self):
+        backend = self.backend()
+        subscriber = backend._subscriber('alice', '20', '1000', '2')
+        match = lambda **fields: backend._match_search(
+                self.ad(backend, **fields), subscriber)
+        self.failUnless(match(prix=1000.0, surface=20.0, nbPiece=2))
+        self.failUnless(match(prix=500.0, surface=80.0, nbPiece=4))
+        self.failIf(match(prix=1000.5, surface=20.0, nbPiece=2))
+        self.failIf(match(prix=1000.0, surface=19.9, nbPiece=2))
+        self.failIf(match(prix=1000.0, surface=20.0, nbPiece=1))
+        #the unknown values are not filtered out
+        self.failUnless(match())
+        self.failIf(match(prix=2000.0))
+
+class ParseTestCase(BackendTestCase):
+
+    def testParsePage(self):
+        backend = self.backend()
+        page = backend._new_page('http://ws.seloger.com/search.xml')
+        source = open(os.path.join(BENCH, 'fixtures', 'search-1.xml'))
+        ads = [backend._extract_ad(annonce, 0, page)
+                for annonce in backend._parse_page(source, page)]
+        source.close()
+        self.assertEqual(len(ads), 50)
+        self.failUnless(page['next'].endswith('SEARCHpg=2'))
+        self.assertEqual(page['seen'][0], (u'86012345', 1394822400))
+        ad = dict(zip(backend.val_xml, ads[0]))
+        self.assertEqual(ad['idAnnonce'], u'86012345')
+        self.assertEqual(ad['titre'], u'Appartement 2 pièces')
+        self.assertEqual(ad['prix'], 1474.0)
+        self.assertEqual(ad['nbPiece'], 2)
+        self.assertEqual(ad['surface'], 46.68)
+        self.assertEqual(ad['cp'], u'75011')
+
+        #the last page has no next page
+        page = backend._new_page('http://ws.seloger.com/search.xml')
+        source = open(os.path.join(BENCH, 'fixtures', 'search-3.xml'))
+        self.assertEqual(len(list(backend._parse_page(source, page))), 50)
+        source.close()
+        self.assertEqual(page['next'], None)
+
+    def testNestedNextPage(self):
+        #only the pageSuivante under the root is the next page
+        backend = self.backend()
+        page = backend._new_page('http://ws.seloger.com/search.xml')
+        source = StringIO.StringIO("""<recherche><annonces>
+            <annonce><idAnnonce>1</idAnnonce>
+            <pageSuivante>http://b</pageSuivante></annonce>
+            </annonces></recherche>""")
+        self.assertEqual(len(list(backend._parse_page(source, page))), 1)
+        self.assertEqual(page['next'], None)
+
+    def testExtractAd(self):
+        backend = self.backend()
+        page = backend._new_page('http://ws.seloger.com/search.xml')
+        extract = lambda xml: backend._extract_ad(etree.fromstring(
+            '<annonce>%s</annonce>' % xml), 1394000000, page)
+        ad = extract('<idAnnonce>1</idAnnonce>'
+                '<dtCreation>2014-03-14T18:40:00</dtCreation>'
+                '<prix>bientôt</prix><surface>20</surface>')
+        self.assertEqual(ad[backend.val_xml.index('prix')], None)
+        self.assertEqual(ad[backend.val_xml.index('surface')], 20.0)
+        self.assertEqual(ad[backend.val_xml.index('titre')], None)
+        #too old, without date, viager
+        self.assertEqual(extract('<idAnnonce>2</idAnnonce>'
+            '<dtCreation>2014-01-01T00:00:00</dtCreation>'), None)
+        self.assertEqual(extract('<idAnnonce>3</idAnnonce>'), None)
+        self.assertEqual(extract('<idAnnonce>4</idAnnonce>'
+            '<dtCreation>2014-03-14T18:40:00</dtCreation>'
+            '<descriptif>Vente en viager occupé</descriptif>'), None)
+        self.assertEqual(extract('<idAnnonce>5</idAnnonce>'
+            '<dtCreation>2014-03-14T18:40:00</dtCreation>'
+            '<permaLien>http://www.seloger.com/viagers/5.htm</permaLien>'),
+            None)
+        #every ad is seen, even the ignored ones
+        self.assertEqual([seen[0] for seen in page['seen']],
+                ['1', '2', '3', '4', '5'])
+
+class CutTransport(object):
+    """transport of the tests: the pages whose url contains one of
+    the strings in cut are truncated in the middle"""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.cut = set()
+        self.urls = []
+        self.statuses = []
+
+    def request(self, url, headers, stream):
+        self.urls.append(url)
+        response = self.transport.request(url, headers, False)
+        self.statuses.append(response.status)
+        for part in self.cut:
+            if part in url:
+                return Response(response.status, response.headers,
+                        response.body[:len(response.body) // 2])
+        return response
+
+    def close(self):
+        self.transport.close()
+
+class LimiterTestCase(SupyTestCase):
+
+    def testWaits(self):
+        limiter = TokenBucket(50, 2)
+        #the saved tokens are taken without waiting
+        limiter.acquire()
+        limiter.acquire()
+        stats = limiter.stats()
+        self.assertEqual((stats['acquired'], stats['delayed'],
+            stats['max_waiting'], stats['wait_time']), (2, 0, 0, 0.0))
+        limiter.acquire()
+        stats = limiter.stats()
+        self.assertEqual((stats['acquired'], stats['delayed'],
+            stats['max_waiting'], stats['waiting']), (3, 1, 1, 0))
+        self.failUnless(0 < stats['wait_time'] < 1, stats['wait_time'])
+
+    def testRate(self):
+        limiter = TokenBucket(8, 4, max_backoff=1)
+        limiter.failure()
+        self.assertEqual(limiter.stats()['rate'], 4)
+        #the saved tokens are dropped
+        self.failUnless(limiter.tokens < 1)
+        for i in range(5):
+            limiter.failure()
+        self.assertEqual(limiter.stats()['rate'], 1)
+        self.assertEqual(limiter.stats()['failures'], 6)
+        for i in range(5):
+            limiter.success()
+        self.assertEqual(limiter.stats()['rate'], 8)
+
+    def testStop(self):
+        limiter = TokenBucket(0.01, 1)
+        limiter.acquire()
+        limiter.stop()
+        start = time.time()
+        self.assertRaises(FetchError, limiter.acquire)
+        self.failUnless(time.time() - start < 1)
+        self.assertEqual(limiter.stats()['waiting'], 0)
+
+class CacheTestCase(SupyTestCase):
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp(prefix='seloger-test-')
+        self.url = 'http://ws.seloger.com/search.xml?cp=75011&idtt=1'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        SupyTestCase.tearDown(self)
+
+    def cache(self, **kwargs):
+        return ResponseCache(os.path.join(self.directory, 'cache'),
+                **kwargs)
+
+    def path(self, cache, url):
+        return cache._path(cache._key(url))
+
+    def testRevalidation(self):
+        server = ReplayServer()
+        transport = CutTransport(HttpTransport(
+            address=('127.0.0.1', server.start())))
+        fetcher = Fetcher(transport, retries=0, cache=self.cache())
+        try:
+            first = fetcher.get(self.url)
+            self.failIf(first.unchanged)
+            second = fetcher.get(self.url)
+            self.failUnless(second.unchanged)
+            self.assertEqual(second.status, 200)
+            self.assertEqual(second.body, first.body)
+            self.assertEqual(transport.statuses, [200, 304])
+        finally:
+            fetcher.close()
+            server.stop()
+
+    def testPut(self):
+        cache = self.cache()
+        cache.put(self.url, Response(200, {'etag': '"a"'}, 'page'))
+        path = self.path(cache, self.url)
+        inode = os.stat(path).st_ino
+        os.utime(path, (0, 0))
+        #the same response is not written again
+        cache.put(self.url, Response(200, {'etag': '"a"'}, 'page'))
+        self.assertEqual(os.stat(path).st_ino, inode)
+        self.failUnless(os.stat(path).st_mtime > 0)
+        cache.put(self.url, Response(200, {'etag': '"b"'}, 'page'))
+        self.assertEqual(cache.get(self.url).etag, '"b"')
+        cache.put(self.url, Response(200, {'etag': '"b"'}, 'other'))
+        self.assertEqual(cache.get(self.url).body, 'other')
+
+    def testExpiry(self):
+        cache = self.cache(ttl=60)
+        cache.put(self.url, Response(200, {}, 'page'))
+        self.assertEqual(cache.get(self.url).body, 'page')
+        #an entry unused for longer than the ttl is removed
+        path = self.path(cache, self.url)
+        os.utime(path, (time.time() - 120, time.time() - 120))
+        cache = self.cache(ttl=60)
+        self.assertEqual(cache.get(self.url), None)
+        self.failIf(os.path.exists(path))
+
+    def testSize(self):
+        cache = self.cache()
+        urls = ['%s&SEARCHpg=%d' % (self.url, n) for n in range(3)]
+        for (n, url) in enumerate(urls):
+            cache.put(url, Response(200, {}, 'x' * 1000))
+            used = time.time() - 100 + n
+            os.utime(self.path(cache, url), (used, used))
+        size = cache.size
+        #the least recently used entry is removed
+        cache = self.cache(max_size=size - 1)
+        self.assertEqual(cache.get(urls[0]), None)
+        self.failIf(cache.get(urls[1]) is None)
+        self.failIf(cache.get(urls[2]) is None)
+        self.failUnless(cache.size <= size - 1)
+
+class TransportTestCase(SupyTestCase):
+    """requests to the replay server (see bench/server.py)"""
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.server = ReplayServer()
+        self.port = self.server.start()
+        self.url = 'http://ws.seloger.com/search.xml?cp=75011&idtt=1'
+
+    def tearDown(self):
+        self.server.stop()
+        SupyTestCase.tearDown(self)
+
+    def testStaleConnection(self):
+        transport = HttpTransport(address=('127.0.0.1', self.port))
+        limiter = TokenBucket(100, 10)
+        fetcher = Fetcher(transport, retries=0, limiter=limiter)
+        self.assertEqual(fetcher.get(self.url).status, 200)
+        ((key, idle), ) = transport.idle.items()
+        stale = idle[0]
+        #the connection of the pool is closed (like by the server)
+        stale.sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(fetcher.get(self.url).status, 200)
+        self.failIf(stale in transport.connections)
+        self.assertEqual(len(transport.idle[key]), 1)
+        #the second request is sent again but it is not a failure
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(fetcher.stats()['errors'], 0)
+        self.assertEqual(limiter.stats()['failures'], 0)
+        transport.close()
+
+    def testLimiterFailures(self):
+        limiter = TokenBucket(100, 10)
+        fetcher = Fetcher(HttpTransport(address=('127.0.0.1', self.port)),
+                retries=0, limiter=limiter)
+        #a client error doesn't slow down the requests
+        self.assertRaises(FetchError, fetcher.get,
+                'http://ws.seloger.com/search.xml?cp=x')
+        self.assertEqual(limiter.stats()['failures'], 0)
+        fetcher.close()
+        #a server which can't be reached does
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        fetcher = Fetcher(HttpTransport(address=('127.0.0.1', port)),
+                retries=0, limiter=limiter)
+        self.assertRaises(FetchError, fetcher.get, self.url)
+        self.assertEqual(limiter.stats()['failures'], 1)
+        self.assertEqual(limiter.stats()['rate'], 50)
+        fetcher.close()
+
+class RefreshTestCase(BackendTestCase):
+    """refreshes against the replay server (see bench/server.py)"""
+
+    def setUp(self):
+        BackendTestCase.setUp(self)
+        self.server = ReplayServer()
+        port = self.server.start()
+        self.transport = CutTransport(HttpTransport(
+            address=('127.0.0.1', port)))
+
+    def tearDown(self):
+        BackendTestCase.tearDown(self)
+        self.server.stop()
+
+    def backend(self, **kwargs):
+        return BackendTestCase.backend(self,
+                fetcher=Fetcher(self.transport, retries=0), **kwargs)
+
+    def count(self, backend, query, *parameters):
+        cursor = backend._getDb().cursor()
+        cursor.row_factory = None
+        return cursor.execute(query, parameters).fetchone()[0]
+
+    def testRefresh(self):
+        backend = self.backend()
+        backend.add_search('alice', '75011', '10', '5000', '1', '1')
+        backend.add_search('bob', '75011', '10', '1000', '1', '1')
+        backend.do_searches()
+        #one query for both searches
+        self.assertEqual(len(self.transport.urls), 3)
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM results"),
+                150)
+        ads = backend.get_new()
+        alice = [ad for ad in ads if ad['owner_id'] == 'alice']
+        bob = [ad for ad in ads if ad['owner_id'] == 'bob']
+        self.assertEqual(len(alice), 150)
+        self.failUnless(0 < len(bob) < 150)
+        for ad in bob:
+            self.failUnless(ad['prix'] is None or ad['prix'] <= 1000)
+        self.assertEqual(backend.get_new(), [])
+
+        #the next refresh stores nothing again
+        backend.do_searches()
+        self.assertEqual(len(self.transport.urls), 6)
+        self.assertEqual(backend.get_new(), [])
+
+    def testFailedPage(self):
+        backend = self.backend()
+        #the ads read before the failure are inserted, then rolled back
+        backend.insert_batch = 10
+        backend.add_search('alice', '75011', '10', '5000', '1', '1')
+        self.transport.cut.add('SEARCHpg=2')
+        backend.do_searches()
+        #the second page is rolled back and the third is not downloaded
+        self.assertEqual(len(self.transport.urls), 2)
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM results"),
+                50)
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM map"), 50)
+        self.assertEqual(self.count(backend,
+            "SELECT COUNT(*) FROM results_text"), 50)
+        self.assertEqual(self.count(backend,
+            "SELECT SUM(number) FROM stats_rooms"),
+            self.count(backend, """SELECT COUNT(*) FROM results
+                WHERE prix IS NOT NULL AND surface > 0
+                AND nbPiece IS NOT NULL"""))
+
+        #the failed search is played again after a backoff
+        url = self.transport.urls[0]
+        now = time.time()
+        self.failIf(backend.poller.is_due(url, now))
+        self.failUnless(backend.poller.is_due(url, now + 1))
+        self.transport.cut.clear()
+        backend.poller = AdaptivePoller()
+        backend.do_searches()
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM results"),
+                150)
+        self.assertEqual(len(backend.get_new()), 150)
+
+    def testDownloadUnlocked(self):
+        backend = self.backend()
+        locked = []
+        request = self.transport.request
+        self.transport.request = lambda url, headers, stream: \
+                locked.append(backend.write_lock.locked()) or \
+                request(url, headers, stream)
+        backend.add_search('alice', '75011', '10', '5000', '1', '1')
+        backend.do_searches()
+        #the pages are not downloaded while the database is locked
+        self.assertEqual(locked, [False, False, False])
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM results"),
+                150)
+
+    def testKnownAdsCutoff(self):
+        backend = self.backend(known_ads_cutoff=10)
+        backend.add_search('alice', '75011', '10', '5000', '1', '1')
+        backend.do_searches()
+        self.assertEqual(len(self.transport.urls), 3)
+        #nothing new: the pagination stops on the first page
+        backend.do_searches()
+        self.assertEqual(len(self.transport.urls), 4)
+        #bob gets every ad, even if alice already has them
+        backend.add_search('bob', '75011', '10', '5000', '1', '1')
+        backend.do_searches()
+        self.assertEqual(len(self.transport.urls), 7)
+        self.assertEqual(len([ad for ad in backend.get_new()
+            if ad['owner_id'] == 'bob']), 150)
+
+    def testConcurrentRefresh(self):
+        backend = self.backend(refresh_threads=3, known_ads_cutoff=10)
+        played = []
+        refresh = backend._refresh_concurrent
+        backend._refresh_concurrent = lambda jobs: \
+                played.append(len(jobs)) or refresh(jobs)
+        for (owner_id, cp) in (('alice', '75011'), ('alice', '75012'),
+                ('bob', '75013')):
+            backend.add_search(owner_id, cp, '10', '5000', '1', '1')
+        backend.do_searches()
+        self.assertEqual(played, [3])
+        self.assertEqual(len(self.transport.urls), 9)
+        for cp in ('75011', '75012', '75013'):
+            self.assertEqual(self.count(backend,
+                "SELECT COUNT(*) FROM results WHERE cp = (?)", cp), 150)
+        self.assertEqual(self.count(backend,
+            "SELECT COUNT(*) FROM map WHERE owner_id = 'alice'"), 300)
+        self.assertEqual(self.count(backend,
+            "SELECT COUNT(*) FROM map WHERE owner_id = 'bob'"), 150)
+        self.assertEqual(len(backend.get_new()), 450)
+
+        #nothing new: each search stops on its first page
+        backend.do_searches()
+        self.assertEqual(played, [3, 3])
+        self.assertEqual(len(self.transport.urls), 12)
+        self.assertEqual(backend.get_new(), [])
+        #except the one with a new subscriber
+        backend.add_search('carol', '75012', '10', '5000', '1', '1')
+        backend.do_searches()
+        self.assertEqual(len(self.transport.urls), 17)
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM results"),
+                450)
+        self.assertEqual(len(backend.get_new()), 150)
+
+    def testUnchangedPages(self):
+        backend = self.backend()
+        backend.fetcher = Fetcher(self.transport, retries=0,
+                cache=ResponseCache(os.path.join(self.directory, 'cache')))
+        parsed = []
+        parse = backend._parse_page
+        backend._parse_page = lambda source, page: \
+                parsed.append(page['url']) or parse(source, page)
+        search_id = backend.add_search('alice', '75011', '10', '5000', '1',
+                '1')
+        backend.do_searches()
+        self.assertEqual(len(parsed), 3)
+        self.assertEqual(len(backend.get_new()), 150)
+        #the pages didn't change, they are not parsed again
+        backend.do_searches()
+        self.assertEqual(len(self.transport.urls), 6)
+        self.assertEqual(self.transport.statuses[3:], [304, 304, 304])
+        self.assertEqual(len(parsed), 3)
+        self.assertEqual(len(backend.stored_pages), 3)
+        #but they are for a new subscriber
+        bob_id = backend.add_search('bob', '75011', '10', '5000', '1', '1')
+        backend.do_searches()
+        self.assertEqual(len(parsed), 6)
+        self.assertEqual(len([ad for ad in backend.get_new()
+            if ad['owner_id'] == 'bob']), 150)
+        #the pages of the searches not played anymore are forgotten
+        backend.disable_search(search_id, 'alice')
+        backend.disable_search(bob_id, 'bob')
+        backend.add_search('alice', '75012', '10', '5000', '1', '1')
+        backend.do_searches()
+        self.assertEqual(len(backend.stored_pages), 3)
+        self.failIf([url for url in backend.stored_pages
+            if 'cp=75012' not in url])
+
+    def testSaveKnown(self):
+        backend = self.backend()
+        backend.add_search('alice', '75011', '10', '5000', '1', '1')
+        backend.do_searches()
+        backend.idle(time.time() + 60)
+        os.utime(backend.known_filename, (0, 0))
+        #the filter didn't change, it's not saved again
+        backend.do_searches()
+        backend.idle(time.time() + 60)
+        self.assertEqual(os.stat(backend.known_filename).st_mtime, 0)
+        backend.close()
+        self.backends.remove(backend)
+        backend = self.backend()
+        backend.idle(time.time() + 60)
+        self.assertEqual(os.stat(backend.known_filename).st_mtime, 0)
+        #new rows
+        backend.add_search('bob', '75011', '10', '5000', '1', '1')
+        backend.do_searches()
+        backend.idle(time.time() + 60)
+        self.failUnless(os.stat(backend.known_filename).st_mtime > 0)
+
+    def testStats(self):
+        backend = self.backend()
+        backend.add_search('alice', '75011', '10', '5000', '1', '1')
+        backend.do_searches()
+        ads = [ad for ad in backend.get_all('alice')
+                if ad['prix'] is not None and ad['surface'] > 0]
+        stats = backend.get_stats('alice')
+        for group in stats['rooms']:
+            prices = [ad['prix'] for ad in ads
+                    if ad['nbPiece'] == group['bucket']]
+            self.assertEqual(group['number'], len(prices))
+            self.assertAlmostEqual(group['price'],
+                    sum(prices) / len(prices))
+        self.assertEqual(sum([group['number'] for group in stats['surface']]),
+                len(ads))
+        surfaces = [ad['surface'] for ad in ads]
+        self.assertEqual(stats['step'], min(5, max(1,
+            int((max(surfaces) - min(surfaces)) / 7))))
+        #filtered by postal code and type of ad
+        self.assertEqual(backend.get_stats('alice', '75011'), stats)
+        self.assertEqual(backend.get_stats('alice', '75012')['rooms'], [])
+        self.assertEqual(backend.get_stats('alice', 'all', '2')['step'], None)
+        #the rollup tables are kept up to date with the inserts
+        backend.rebuild_stats()
+        self.assertEqual(self.summary(backend.get_stats('alice')),
+                self.summary(stats))
+
+    def testPrune(self):
+        backend = self.backend(retention_days=60)
+        backend.add_search('alice', '75011', '10', '5000', '1', '1')
+        search_id = backend.add_search('bob', '75012', '10', '5000', '1', '1')
+        backend.do_searches()
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM results"),
+                300)
+        #the only search of bob is disabled, some ads of alice expire
+        backend.disable_search(search_id, 'bob')
+        db = backend._getDb()
+        db.execute("""UPDATE results SET dtCreation = 0
+                      WHERE idAnnonce IN (SELECT idAnnonce FROM results
+                                          WHERE cp = '75011' LIMIT 20)""")
+        db.commit()
+        #by small transactions
+        backend.prune_batch = 7
+        backend.prune(time.time() + 60)
+        self.assertEqual(self.count(backend,
+            "SELECT COUNT(*) FROM map WHERE owner_id = 'bob'"), 0)
+        self.assertEqual(self.count(backend,
+            "SELECT COUNT(*) FROM results WHERE cp = '75012'"), 0)
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM results"),
+                130)
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM map"), 130)
+        self.assertEqual(self.count(backend,
+            "SELECT COUNT(*) FROM results_text"), 130)
+        self.assertEqual(backend.get_stats('bob')['rooms'], [])
+        stats = self.summary(backend.get_stats('alice'))
+        backend.rebuild_stats()
+        self.assertEqual(self.summary(backend.get_stats('alice')), stats)
+        self.assertEqual(self.count(backend, "PRAGMA freelist_count"), 0)
+
+    def testPruneOwners(self):
+        backend = self.backend(retention_days=60)
+        backend.add_search('alice', '75011', '10', '5000', '1', '1')
+        search_id = backend.add_search('bob', '75012', '10', '5000', '1', '1')
+        backend.add_search('carol', '75013', '10', '5000', '1', '1')
+        backend.do_searches()
+        #every owner is checked once after the start
+        backend.prune(time.time() + 60)
+        self.assertEqual(backend.pruned_owners, set())
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM map"), 450)
+        #then only the owners who disabled a search
+        db = backend._getDb()
+        db.execute("DELETE FROM searches WHERE owner_id = 'carol'")
+        db.commit()
+        backend.disable_search(search_id, 'bob')
+        self.assertEqual(backend.pruned_owners, set(['bob']))
+        backend.prune(time.time() + 60)
+        self.assertEqual(backend.pruned_owners, set())
+        self.assertEqual(self.count(backend,
+            "SELECT COUNT(*) FROM map WHERE owner_id = 'bob'"), 0)
+        self.assertEqual(self.count(backend,
+            "SELECT COUNT(*) FROM map WHERE owner_id = 'carol'"), 150)
+        backend.close()
+        self.backends.remove(backend)
+        backend = self.backend(retention_days=60)
+        backend.prune(time.time() + 60)
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM map"), 150)
+        self.assertEqual(self.count(backend, "SELECT COUNT(*) FROM results"),
+                150)
+
+class SchedulerTestCase(SupyTestCase):
+
+    def testCycles(self):
+        cycles = []
+        idle = []
+        finished = threading.Event()
+        def cycle():
+            cycles.append(time.time())
+            return 0
+        scheduler = RefreshScheduler(cycle, 3600, log,
+                idle=idle.append, finish=finished.set)
+        scheduler.start()
+        #at least one second between two cycles, even if a search is due
+        time.sleep(1.5)
+        start = time.time()
+        scheduler.stop(5)
+        self.failUnless(time.time() - start < 1)
+        self.failIf(scheduler.isAlive())
+        self.failUnless(finished.isSet())
+        self.assertEqual(len(cycles), 2)
+        self.failUnless(cycles[1] - cycles[0] >= 1)
+        self.assertEqual(len(idle), 2)
+        self.failUnless(cycles[0] < idle[0] <= cycles[1])
+
+    def testStopTimeout(self):
+        running = threading.Event()
+        release = threading.Event()
+        finished = threading.Event()
+        def cycle():
+            running.set()
+            release.wait(10)
+        scheduler = RefreshScheduler(cycle, 3600, log,
+                finish=finished.set)
+        scheduler.start()
+        running.wait(5)
+        #the cycle in progress is not interrupted
+        start = time.time()
+        scheduler.stop(0.2)
+        self.failUnless(time.time() - start < 1)
+        self.failUnless(scheduler.isAlive())
+        self.failIf(finished.isSet())
+        release.set()
+        scheduler.join(5)
+        self.failIf(scheduler.isAlive())
+        self.failUnless(finished.isSet())
+
+    def testFailedCycle(self):
+        cycles = []
+        def cycle():
+            cycles.append(None)
+            raise ValueError('cycle')
+        scheduler = RefreshScheduler(cycle, 1, log)
+        scheduler.start()
+        time.sleep(1.5)
+        scheduler.stop(5)
+        #the thread goes on after an error
+        self.assertEqual(len(cycles), 2)
+
+class GenerateTestCase(BackendTestCase):
+    """the synthetic database of the benchmarks (see bench/generate.py)"""
+
+    def testGenerate(self):
+        backend = self.backend()
+        map_rows = generate(backend, 500, 20, matches=20)
+        backend.close()
+        self.backends.remove(backend)
+        backend = self.backend()
+        db = backend._getDb()
+        #the generated rows are in the filter of the stored ads
+        ids = [row[0] for row in db.execute("SELECT idAnnonce FROM results")]
+        self.failUnless(len(ids) >= 490)
+        self.failIf([i for i in ids if i not in backend.known])
+        uniq_ids = [row[0] for row in db.execute("SELECT uniq_id FROM map")]
+        self.assertEqual(len(uniq_ids), map_rows)
+        self.failIf([i for i in uniq_ids if i not in backend.known])
+
+class PollerTestCase(SupyTestCase):
+
+    def testInterval(self):
+        poller = AdaptivePoller(min_interval=60, max_interval=3600)
+        self.failUnless(poller.is_due('a', 0))
+        self.assertEqual(poller.next_due(0), None)
+        #unknown rate: min_interval
+        poller.record('a', 0, 1000)
+        self.failIf(poller.is_due('a', 1059))
+        self.failUnless(poller.is_due('a', 1060))
+        #no new ads: max_interval
+        poller.record('a', 0, 1100)
+        self.assertEqual(poller.next_due(1100), 3600)
+        #a lot of new ads: min_interval
+        poller.record('a', 1000, 1200)
+        self.assertEqual(poller.next_due(1200), 60)
+        #between the two
+        poller = AdaptivePoller(min_interval=60, max_interval=3600,
+                target=1, smoothing=1)
+        poller.record('a', 0, 0)
+        poller.record('a', 1, 1000)
+        self.assertEqual(poller.next_due(1000), 1000)
+
+    def testFailed(self):
+        poller = AdaptivePoller(min_interval=60, max_interval=300)
+        delays = []
+        for now in range(0, 5000, 1000):
+            poller.failed('a', now)
+            delays.append(poller.next_due(now))
+        self.assertEqual(delays, [60, 120, 240, 300, 300])
+        #a poll which worked ends the backoff
+        poller.record('a', 0, 10000)
+        poller.failed('a', 10000)
+        self.assertEqual(poller.next_due(10000), 60)
+        #at least one second, even without min_interval
+        poller = AdaptivePoller()
+        poller.failed('a', 0)
+        self.failIf(poller.is_due('a', 0))
+        self.failUnless(poller.is_due('a', 1))
+
+    def testForget(self):
+        poller = AdaptivePoller(min_interval=60, max_interval=3600)
+        poller.record('a', 0, 0)
+        poller.record('b', 0, 30)
+        poller.forget(set(['b']))
+        self.failUnless(poller.is_due('a', 0))
+        self.assertEqual(poller.next_due(0), 90)
+        poller.forget(set())
+        self.assertEqual(poller.next_due(0), None)
+
+class RecordTestCase(SupyTestCase):
+
+    def testRecord(self):
+        cls = record_type(('a', 'b'))
+        self.failUnless(record_type(('a', 'b')) is cls)
+        record = cls((1, 2))
+        self.assertEqual(record['b'], 2)
+        self.assertEqual(record[0], 1)
+        self.assertEqual(record.get('c', 3), 3)
+        self.assertEqual(record.keys(), ['a', 'b'])
+        self.assertEqual(dict(record), {'a': 1, 'b': 2})
+        self.failUnless('a' in record)
+        self.failIf('c' in record)
+        self.assertRaises(KeyError, lambda: record['c'])
+
+    def testFactory(self):
+        db = sqlite3.connect(':memory:')
+        db.row_factory = RecordFactory()
+        first = db.execute("SELECT 1 AS a, 2 AS b").fetchone()
+        second = db.execute("SELECT 3 AS b").fetchone()
+        self.assertEqual((first['a'], first['b'], second['b']), (1, 2, 3))
+        self.assertEqual(list(first), [1, 2])
+        db.close()
+
+class BloomTestCase(SupyTestCase):
+
+    def testBloom(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(str(i))
+        bloom.add(u'é')
+        self.assertEqual(len(bloom), 1001)
+        for i in range(1000):
+            self.failUnless(str(i) in bloom)
+        self.failUnless(u'é' in bloom)
+        false = len([i for i in range(1000, 11000) if str(i) in bloom])
+        self.failUnless(false < 300, false)
+
+    def testSave(self):
+        directory = tempfile.mkdtemp(prefix='seloger-test-')
+        try:
+            filename = os.path.join(directory, 'known')
+            bloom = BloomFilter(100)
+            bloom.add('a')
+            bloom.save(filename, {'map': 3})
+            (loaded, marks) = BloomFilter.load(filename)
+            self.assertEqual(marks, {'map': 3})
+            self.failUnless('a' in loaded)
+            self.assertEqual(len(loaded), 1)
+            #a truncated file is refused
+            data = open(filename, 'rb').read()
+            open(filename, 'wb').write(data[:-1])
+            self.assertRaises(ValueError, BloomFilter.load, filename)
+        finally:
+            shutil.rmtree(directory)
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: